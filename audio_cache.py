@@ -0,0 +1,128 @@
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from resample import RESAMPLER_VERSION
+
+
+SAMPLE_RATE = 16000
+CACHE_INDEX = 'index.csv'
+INDEX_COLUMNS = ['filename', 'size', 'mtime', 'resampler', 'offset', 'length']
+INT16_SCALE = 32767.0
+
+
+class AudioCache:
+    """ Pre-resampled 16 kHz mono audio in one flat file, with an index of sample offsets per source file.
+
+    Samples are stored as int16 (half the size, 16-bit accuracy) or float32 (exact), in ``audio.<dtype>``.
+    An entry only counts as a hit while the source file keeps the size and mtime it had when it was converted, and
+    it was converted by the current resampler (resample.RESAMPLER_VERSION).
+    """
+
+    def __init__(self, cache_dir, dtype='int16'):
+        self.cache_dir = cache_dir
+        self.dtype = np.dtype(dtype)
+        self.data_path = os.path.join(cache_dir, f'audio.{self.dtype.name}')
+        self.index_path = os.path.join(cache_dir, CACHE_INDEX)
+        self._data = None
+
+        os.makedirs(cache_dir, exist_ok=True)
+        if os.path.isfile(self.index_path):
+            self.index = (pd.read_csv(self.index_path).reindex(columns=INDEX_COLUMNS)
+                          .drop_duplicates('filename', keep='last').set_index('filename'))
+        else:
+            self.index = pd.DataFrame(columns=INDEX_COLUMNS).set_index('filename')
+
+    def data(self):
+        if self._data is None:
+            if not os.path.isfile(self.data_path) or os.path.getsize(self.data_path) == 0:
+                return None
+            self._data = np.memmap(self.data_path, dtype=self.dtype, mode='r')
+        return self._data
+
+    def is_fresh(self, filename):
+        if filename not in self.index.index:
+            return False
+        entry = self.index.loc[filename]
+        stat = os.stat(filename)
+        return (entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns
+                and entry['resampler'] == RESAMPLER_VERSION)
+
+    def read(self, filename):
+        """ Cached float32 waveform of filename, or None on a miss. """
+        if not self.is_fresh(filename):
+            return None
+        entry = self.index.loc[filename]
+        wav = self.data()[int(entry['offset']):int(entry['offset']) + int(entry['length'])]
+        if self.dtype == np.int16:
+            return wav.astype(np.float32) / INT16_SCALE
+        return np.array(wav)
+
+    def lookup(self, filename):
+        """ tf.numpy_function friendly read: (waveform, hit). """
+        if isinstance(filename, bytes):
+            filename = filename.decode('utf-8')
+        wav = self.read(filename)
+        if wav is None:
+            return np.zeros(0, dtype=np.float32), np.bool_(False)
+        return wav, np.bool_(True)
+
+    def build(self, filenames, processes=None):
+        """ Convert every stale or missing file of filenames into the cache, decoding in parallel across cores. """
+        pending = [filename for filename in filenames if not self.is_fresh(filename)]
+        if not pending:
+            return 0
+
+        start = time.time()
+        processes = processes or os.cpu_count()
+        rows = []
+        offset = os.path.getsize(self.data_path) // self.dtype.itemsize if os.path.isfile(self.data_path) else 0
+        # spawn - the caller has usually imported TensorFlow already, and its thread pools do not survive a fork
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(processes, initializer=_init_worker) as pool, open(self.data_path, 'ab') as data_file:
+            for filename, size, mtime, wav in pool.imap_unordered(_convert, pending, chunksize=8):
+                if self.dtype == np.int16:
+                    wav = np.round(np.clip(wav, -1.0, 1.0) * INT16_SCALE)
+                data_file.write(wav.astype(self.dtype).tobytes())
+                rows.append({'filename': filename, 'size': size, 'mtime': mtime, 'resampler': RESAMPLER_VERSION,
+                             'offset': offset, 'length': len(wav)})
+                offset += len(wav)
+
+        self._data = None
+        added = pd.DataFrame(rows, columns=INDEX_COLUMNS).set_index('filename')
+        self.index = pd.concat([self.index[~self.index.index.isin(added.index)], added])
+        tmp_path = self.index_path + '.tmp'
+        self.index.to_csv(tmp_path)
+        os.replace(tmp_path, self.index_path)
+
+        print(f'converted {len(rows)} files in {time.time() - start:.1f}s with {processes} processes')
+        return len(rows)
+
+
+def _init_worker():
+    # one decode per core - keep TensorFlow from spreading each one over every core again
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(1)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+def _convert(filename):
+    from data import decode_wav_16k_mono
+    stat = os.stat(filename)
+    wav = decode_wav_16k_mono(filename).numpy()
+    return filename, stat.st_size, stat.st_mtime_ns, wav
+
+
+if __name__ == '__main__':
+    # usage: python audio_cache.py <dataset path> <cache dir> [int16|float32]
+    from data import load_metadata
+
+    dataset_path = sys.argv[1]
+    cache_dir = sys.argv[2]
+    dtype = sys.argv[3] if len(sys.argv) > 3 else 'int16'
+
+    metadata, _ = load_metadata(dataset_path)
+    AudioCache(cache_dir, dtype).build(list(metadata['filename']))
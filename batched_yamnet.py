@@ -0,0 +1,178 @@
+import numpy as np
+
+from timeline import HOP_SAMPLES, PATCH_SAMPLES, num_frames
+
+
+# patches per YAMNet call - about 8 minutes of 16 kHz audio
+PATCHES_PER_CALL = 1024
+# patches between two packed clips, they straddle both and are dropped
+GAP_PATCHES = 2
+
+
+def pack(wavs):
+    """ Lay 16 kHz clips out in one waveform so that YAMNet's patches of it include exactly the patches of each clip.
+
+    YAMNet pads a lone clip with zeros to a whole number of 0.48 s hops past its first 0.96 s patch, and every patch
+    only sees its own 15600 samples. So each clip starts on a hop, is followed by its own zero padding, and the next
+    clip starts GAP_PATCHES hops after its last patch - far enough that no kept patch sees a neighbouring clip.
+    Returns (waveform, first patch of each clip, number of patches of each clip).
+    """
+    counts = np.array([num_frames(len(wav)) for wav in wavs], dtype=np.int64)
+    starts = np.concatenate([[0], np.cumsum(counts[:-1] + GAP_PATCHES)])
+    waveform = np.zeros(HOP_SAMPLES * (starts[-1] + counts[-1] - 1) + PATCH_SAMPLES, dtype=np.float32)
+    for wav, start in zip(wavs, starts):
+        waveform[HOP_SAMPLES * start:HOP_SAMPLES * start + len(wav)] = wav
+    return waveform, starts, counts
+
+def call_groups(wavs, patches_per_call=PATCHES_PER_CALL):
+    """ Consecutive [first, last) clip ranges whose packed patches fit one call, a longer clip gets a call of its own. """
+    groups = []
+    first = 0
+    patches = 0
+    for i, wav in enumerate(wavs):
+        count = num_frames(len(wav)) + GAP_PATCHES
+        if i > first and patches + count > patches_per_call:
+            groups.append((first, i))
+            first = i
+            patches = 0
+        patches += count
+    if first < len(wavs):
+        groups.append((first, len(wavs)))
+    return groups
+
+def embed_clips(yamnet_model, wavs, patches_per_call=PATCHES_PER_CALL):
+    """ Per-frame YAMNet embeddings of each 16 kHz clip, the frames yamnet_model(wav) gives for it on its own.
+
+    Clips are packed into one waveform per call, so the frontend and network run on up to patches_per_call patches
+    of many clips at once instead of one short clip per call.
+    """
+    embeddings = []
+    for first, last in call_groups(wavs, patches_per_call):
+        waveform, starts, counts = pack(wavs[first:last])
+        _, frames, _ = yamnet_model(waveform)
+        frames = frames.numpy()
+        if len(frames) != starts[-1] + counts[-1]:
+            raise ValueError(f'YAMNet returned {len(frames)} patches for {starts[-1] + counts[-1]} packed patches')
+        embeddings += [frames[start:start + count] for start, count in zip(starts, counts)]
+    return embeddings
+
+def patch_counts(lengths):
+    """ num_frames of each clip length, in TensorFlow ops so it can be part of an exported graph. """
+    import tensorflow as tf
+
+    return 1 + (tf.maximum(lengths - PATCH_SAMPLES, 0) + HOP_SAMPLES - 1) // HOP_SAMPLES
+
+def pack_batch(waveforms, lengths):
+    """ pack for a padded (clips, samples) batch inside a graph, only the first length samples of each row are used.
+
+    Returns the packed waveform and a (clips, patches) 0/1 matrix of which of its patches belong to which clip,
+    so the per-clip mean of per-patch values is one matmul and gap patches fall out of every mean.
+    Only builtin TFLite ops are used.
+    """
+    import tensorflow as tf
+
+    samples = tf.shape(waveforms)[1]
+    lengths = tf.minimum(tf.cast(lengths, tf.int32), samples)
+    counts = patch_counts(lengths)
+    starts = tf.cumsum(counts + GAP_PATCHES, exclusive=True)
+    total_patches = starts[-1] + counts[-1]
+
+    offsets = tf.range(samples)[None, :]
+    valid = offsets < lengths[:, None]
+    positions = tf.boolean_mask(HOP_SAMPLES * starts[:, None] + offsets, valid)
+    waveform = tf.scatter_nd(positions[:, None], tf.boolean_mask(waveforms, valid),
+                             [HOP_SAMPLES * (total_patches - 1) + PATCH_SAMPLES])
+
+    patches = tf.range(total_patches)[None, :]
+    membership = (patches >= starts[:, None]) & (patches < (starts + counts)[:, None])
+    return waveform, tf.cast(membership, tf.float32)
+
+def clip_mean(patch_values, membership):
+    """ Mean of the (patches, ...) values over each clip's own patches, the ReduceMeanLayer of each lone clip. """
+    import tensorflow as tf
+
+    return tf.matmul(membership, patch_values) / tf.reduce_sum(membership, axis=1, keepdims=True)
+
+def frame_patches(waveform, frames):
+    """ (frames, 15600) YAMNet patches of a 16 kHz waveform tensor, zero padded past its end as YAMNet pads it. """
+    import tensorflow as tf
+
+    padded = tf.pad(waveform, [[0, HOP_SAMPLES * (frames - 1) + PATCH_SAMPLES - tf.shape(waveform)[0]]])
+    return tf.signal.frame(padded, PATCH_SAMPLES, HOP_SAMPLES)
+
+def pad_batch(wavs):
+    """ (padded (clips, samples) float32 batch, int32 lengths) of 16 kHz clips, the input of the batched signature. """
+    lengths = np.array([len(wav) for wav in wavs], dtype=np.int32)
+    waveforms = np.zeros((len(wavs), max(lengths.max(), 1)), dtype=np.float32)
+    for row, wav in zip(waveforms, wavs):
+        row[:len(wav)] = wav
+    return waveforms, lengths
+
+def clip_logits(yamnet_layer, head, embeddings, waveform, membership, silence_filter=None):
+    """ (clips, classes) mean head logits over each clip's frames, membership as pack_batch returns it.
+
+    With a vad.SilenceFilter its silent frames are handled in the graph as they were for training, see
+    SilenceFilter.clip_logits.
+    """
+    import tensorflow as tf
+
+    if silence_filter is None:
+        return clip_mean(head(embeddings), membership)
+    patches = frame_patches(waveform, tf.shape(embeddings)[0])
+    return silence_filter.clip_logits(yamnet_layer, head, embeddings, patches, membership)
+
+def clip_signature(yamnet_layer, head, silence_filter=None):
+    """ The single-clip serving signature: (classes,) mean logits of one 16 kHz waveform. """
+    import tensorflow as tf
+
+    if silence_filter is not None:
+        # computed eagerly, the traced signature only reads the cached value
+        silence_filter.silence_embedding(yamnet_layer)
+
+    @tf.function(input_signature=[tf.TensorSpec(shape=(None,), dtype=tf.float32, name='audio')])
+    def serving_default(audio):
+        _, embeddings, _ = yamnet_layer(audio)
+        membership = tf.ones([1, tf.shape(embeddings)[0]])
+        return {'classifier': clip_logits(yamnet_layer, head, embeddings, audio, membership, silence_filter)[0]}
+
+    return serving_default
+
+def batch_signature(yamnet_layer, head, silence_filter=None):
+    """ The batched serving signature: (clips, classes) logits of a padded batch and its lengths in one YAMNet call.
+
+    Each row's logits are the mean of the head over that clip's own frames only, what the single-clip signature
+    gives for the unpadded clip.
+    """
+    import tensorflow as tf
+
+    if silence_filter is not None:
+        silence_filter.silence_embedding(yamnet_layer)
+
+    @tf.function(input_signature=[
+        tf.TensorSpec(shape=(None, None), dtype=tf.float32, name='audio'),
+        tf.TensorSpec(shape=(None,), dtype=tf.int32, name='lengths'),
+    ])
+    def serving_batch(audio, lengths):
+        waveform, membership = pack_batch(audio, lengths)
+        _, embeddings, _ = yamnet_layer(waveform)
+        return {'classifier': clip_logits(yamnet_layer, head, embeddings, waveform, membership, silence_filter)}
+
+    return serving_batch
+
+def verify_batch_signature(saved_model_path, wavs, tolerance=1e-4):
+    """ Largest difference between the serving_batch and serving_default signatures of an export over the clips.
+
+    Raises ValueError past tolerance, the batched signature must score every clip as the single-clip one does.
+    """
+    import tensorflow as tf
+
+    saved_model = tf.saved_model.load(saved_model_path)
+    single = saved_model.signatures['serving_default']
+    batch = saved_model.signatures['serving_batch']
+    waveforms, lengths = pad_batch(wavs)
+    batched = batch(audio=tf.constant(waveforms), lengths=tf.constant(lengths))['classifier'].numpy()
+    expected = np.stack([single(audio=tf.constant(wav, dtype=tf.float32))['classifier'].numpy() for wav in wavs])
+    difference = float(np.abs(batched - expected).max())
+    if difference > tolerance:
+        raise ValueError(f'serving_batch differs from serving_default by {difference} over {len(wavs)} clips')
+    return difference
@@ -0,0 +1,510 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+
+import numpy as np
+
+
+SEED = 0
+# sample rates and lengths (seconds) of the synthetic class-folder corpus, cycled through clip by clip
+CORPUS_RATES = [16000, 22050, 44100, 48000]
+CORPUS_SECONDS = [1, 5, 30]
+CLIPS_PER_CLASS = 20
+# synthetic PSG exports converted by metadata, and the recording trimmed by trimmer
+TSV_FILES = 4
+TSV_EVENTS = 20000
+# one whole-night export at the size the vectorized conversion was measured on
+LARGE_TSV_EVENTS = 100000
+RECORDING_SECONDS = 600
+RECORDING_RATE = 44100
+RECORDING_START = '20210101_210000'
+# clips per class of the corpus the split benchmark iterates, one second each - a few thousand clips in all
+SPLIT_CLIPS_PER_CLASS = 500
+SPLIT_SECONDS = [1]
+# synthetic frames the head is trained on, and the epochs it runs
+HEAD_FRAMES = 100000
+HEAD_EPOCHS = 20
+# source rates resampled to 16 kHz, and the seconds of audio resampled from each
+RESAMPLE_RATES = [22050, 44100, 48000]
+RESAMPLE_SECONDS = 600
+# clips scored per inference backend
+INFERENCE_CLIPS = 50
+REPEATS = 3
+# a benchmark is a regression when it is this much slower than the baseline
+THRESHOLD = 0.1
+
+# stages and events in the proportions of a real night, N/A rows included
+TSV_STAGES = ['SLEEP-S0', 'SLEEP-S1', 'SLEEP-S2', 'SLEEP-S2', 'SLEEP-S3', 'SLEEP-REM', 'N/A']
+TSV_EVENTS_NAMES = ['SLEEP-S0', 'SLEEP-S1', 'SLEEP-S2', 'SLEEP-S3', 'SLEEP-REM', 'SNORE-SINGLE', 'SNORE', 'HYPOPNEA',
+                    'AROUSAL-RESP', 'APNEA-OBSTRUCTIVE']
+TSV_HEADER = ['Sleep Stage', 'Position', 'Time [hh:mm:ss]', 'Event', 'Duration[s]']
+
+
+def write_wav(path, samples, rate):
+    """ Write float samples in [-1, 1) as a mono 16-bit PCM WAV. """
+    with wave.open(path, 'wb') as output:
+        output.setnchannels(1)
+        output.setsampwidth(2)
+        output.setframerate(rate)
+        output.writeframes((np.clip(samples, -1, 1 - 1 / 32768) * 32768).astype('<i2').tobytes())
+
+def synthetic_audio(rng, seconds, rate):
+    """ Noise with a few random tones - cheap to make, but not silence, so no decoder or model takes a shortcut. """
+    t = np.arange(int(seconds * rate), dtype=np.float32) / rate
+    samples = 0.05 * rng.standard_normal(len(t)).astype(np.float32)
+    for frequency in rng.uniform(80, 4000, size=3):
+        samples += 0.1 * np.sin(2 * np.pi * frequency * t, dtype=np.float32)
+    return samples
+
+def generate_corpus(root, classes, clips_per_class=CLIPS_PER_CLASS, rates=CORPUS_RATES, seconds=CORPUS_SECONDS,
+                    seed=SEED):
+    """ Write clips_per_class WAVs into root/<class>/ for each class, the layout data.load reads.
+
+    Clips cycle through the given sample rates and lengths, so resampling and padding paths all run.
+    Returns the total seconds of audio written.
+    """
+    rng = np.random.default_rng(seed)
+    total = 0.0
+    for class_name in classes:
+        os.makedirs(os.path.join(root, class_name), exist_ok=True)
+        for i in range(clips_per_class):
+            rate = rates[i % len(rates)]
+            length = seconds[i % len(seconds)]
+            write_wav(os.path.join(root, class_name, f'{class_name}_{i:05d}.wav'), synthetic_audio(rng, length, rate), rate)
+            total += length
+    return total
+
+def korean_time(seconds, pad):
+    """ Time of day as the PSG export writes it, e.g. '오후 9:05:00', with or without a padded hour. """
+    seconds %= 86400
+    hour, minute, second = seconds // 3600, seconds // 60 % 60, seconds % 60
+    prefix = '오전' if hour < 12 else '오후'
+    hour = hour % 12 or 12
+    return f'{prefix} {hour:02d}:{minute:02d}:{second:02d}' if pad else f'{prefix} {hour}:{minute:02d}:{second:02d}'
+
+def generate_tsv(path, events=TSV_EVENTS, start_seconds=21 * 3600, seed=SEED, max_gap=120):
+    """ Write a PSG event export in the format metadata.import_tsv_content reads.
+
+    Events start at start_seconds past midnight, in order, and cross midnight if there are enough of them.
+    Returns the seconds past start_seconds of the last event.
+    """
+    rng = np.random.default_rng(seed)
+    pad = bool(rng.integers(2))
+    gaps = rng.choice([0, 5, 10, 30, 30, 30, 45, 60, max_gap], size=events)
+    durations = rng.choice([1, 5, 10, 30, 30, 30, 60, 200], size=events)
+    stages = rng.choice(TSV_STAGES, size=events)
+    names = rng.choice(TSV_EVENTS_NAMES, size=events)
+    offsets = np.cumsum(gaps)
+    with open(path, 'w', encoding='utf-8') as output:
+        output.write('Patient\tSynthetic\nRecording Date\t2021-01-01\n')
+        output.write('\t'.join(TSV_HEADER) + '\n')
+        for stage, offset, name, duration in zip(stages, offsets, names, durations):
+            output.write(f'{stage}\tSupine\t{korean_time(int(start_seconds + offset), pad)}\t{name}\t{duration}\n')
+    return int(offsets[-1]) if events else 0
+
+def generate_recording(directory, device='go001', trial=1, seconds=RECORDING_SECONDS, rate=RECORDING_RATE, seed=SEED):
+    """ A whole-night recording and its annotation csv, named the way trimmer.trim_file expects.
+
+    The csv is the metadata conversion of a synthetic TSV whose events span the recording.
+    Returns (recording path, csv path), relative to directory.
+    """
+    from certificate import metadata
+
+    date, clock = RECORDING_START.split('_')
+    audio_name = f'{device}_{trial}_{date}_{clock}.wav'
+    tsv_name = f'{device}_{trial}.tsv'
+    csv_name = f'{device}_{trial}_sleep scoring.csv'
+    write_wav(os.path.join(directory, audio_name), synthetic_audio(np.random.default_rng(seed), seconds, rate), rate)
+
+    start_seconds = int(clock[:2]) * 3600 + int(clock[2:4]) * 60 + int(clock[4:])
+    generate_tsv(os.path.join(directory, tsv_name), events=seconds // 30, start_seconds=start_seconds, seed=seed,
+                 max_gap=30)
+    content, _ = metadata.convert_content(os.path.join(directory, tsv_name), date)
+    with open(os.path.join(directory, csv_name), 'w') as output:
+        output.write(content)
+    return audio_name, csv_name
+
+
+def timed(fn, repeats=REPEATS, setup=None):
+    """ (result of the last call, median and min seconds over repeats calls of fn), running setup untimed before each. """
+    times = []
+    result = None
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return result, {'seconds': statistics.median(times), 'min_seconds': min(times), 'repeats': repeats}
+
+def throughput(timing, items, unit):
+    timing['items'] = items
+    timing[f'{unit}_per_s'] = items / timing['seconds'] if timing['seconds'] else 0.0
+    return timing
+
+def bench_metadata(work_dir, repeats):
+    """ metadata.convert_to over synthetic TSVs, and convert_content over one LARGE_TSV_EVENTS TSV.
+
+    convert itself writes to fixed paths outside the work directory, so it is not timed.
+    """
+    from certificate import metadata
+
+    tsv_dir = os.path.join(work_dir, 'tsv')
+    output_dir = os.path.join(work_dir, 'csv')
+    os.makedirs(tsv_dir, exist_ok=True)
+    os.makedirs(output_dir, exist_ok=True)
+    pairs = []
+    for i in range(TSV_FILES):
+        path = os.path.join(tsv_dir, f'go{i + 1:03d}_1.tsv')
+        generate_tsv(path, seed=SEED + i)
+        pairs.append((path, RECORDING_START.split('_')[0]))
+
+    _, timing = timed(lambda: [metadata.convert_to(path, date, output_dir) for path, date in pairs], repeats)
+    results = {'metadata.convert': throughput(timing, TSV_FILES * TSV_EVENTS, 'events')}
+
+    large_path = os.path.join(tsv_dir, 'go100_1.tsv')
+    generate_tsv(large_path, events=LARGE_TSV_EVENTS, seed=SEED)
+    date = RECORDING_START.split('_')[0]
+    _, timing = timed(lambda: metadata.convert_content(large_path, date), repeats)
+    results['metadata.convert_content/100k'] = throughput(timing, LARGE_TSV_EVENTS, 'events')
+    return results
+
+def bench_trimmer(work_dir, repeats):
+    """ trimmer.trim_file over one synthetic recording, with one ffmpeg per event and with a single decode. """
+    from certificate import trimmer
+
+    directory = os.path.join(work_dir, 'trim')
+    os.makedirs(directory, exist_ok=True)
+    audio_name, csv_name = generate_recording(directory)
+
+    results = {}
+    # trimmer writes its slices under result\ next to the relative recording path
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        for name, single_decode in [('ffmpeg', False), ('single_decode', True)]:
+            def clean():
+                # trim_wav skips slices that already exist
+                for entry in os.listdir('.'):
+                    if entry.startswith('result'):
+                        shutil.rmtree(entry)
+
+            def trim():
+                with contextlib.redirect_stdout(open(os.devnull, 'w')):
+                    trimmer.trim_file(audio_name, csv_name, single_decode=single_decode)
+
+            _, timing = timed(trim, repeats, setup=clean)
+            results[f'trimmer.trim_file/{name}'] = throughput(timing, RECORDING_SECONDS, 'audio_seconds')
+    finally:
+        os.chdir(cwd)
+    return results
+
+def bench_resample(work_dir, repeats):
+    """ resample.resample against tfio.audio.resample from each source rate to 16 kHz, with both one's fidelity.
+
+    Filter design is timed on its own, it happens once per rate pair. tfio is left out if it is not installed.
+    """
+    import resample
+
+    try:
+        import tensorflow as tf
+        import tensorflow_io as tfio
+    except ImportError:
+        tfio = None
+
+    def tfio_resample(samples, rate_in, rate_out):
+        return tfio.audio.resample(tf.constant(samples), rate_in=rate_in, rate_out=rate_out).numpy()
+
+    rng = np.random.default_rng(SEED)
+    results = {}
+    for rate in RESAMPLE_RATES:
+        samples = synthetic_audio(rng, RESAMPLE_SECONDS, rate)
+        _, results[f'resample/design_{rate}'] = timed(lambda: resample.Resampler(rate), repeats)
+        resample.resampler(rate)
+        _, timing = timed(lambda: resample.resample(samples, rate), repeats)
+        timing.update(resample.fidelity(rate))
+        results[f'resample/{rate}'] = throughput(timing, RESAMPLE_SECONDS, 'audio_seconds')
+        if tfio is not None:
+            _, timing = timed(lambda: tfio_resample(samples, rate, resample.SAMPLE_RATE), repeats)
+            timing.update(resample.fidelity(rate, resample_fn=tfio_resample))
+            results[f'resample/tfio_{rate}'] = throughput(timing, RESAMPLE_SECONDS, 'audio_seconds')
+    return results
+
+def read_bytes():
+    """ Bytes this process has read through read syscalls so far (rchar, page cache hits included), None off Linux. """
+    try:
+        with open('/proc/self/io') as f:
+            return int(dict(line.split(': ') for line in f.read().splitlines())['rchar'])
+    except OSError:
+        return None
+
+def filtered_splits(metadata, num_classes):
+    """ The splits as data.load used to build them: every file decoded in one pipeline, then filtered per split. """
+    import tensorflow as tf
+    from data import load_wav_for_map
+
+    labels = tf.keras.utils.to_categorical(metadata['target'], num_classes)
+    dataset = tf.data.Dataset.from_tensor_slices((metadata['filename'], labels, metadata['split']))
+    dataset = dataset.map(load_wav_for_map)
+    return {split: dataset.filter(lambda wav, target, in_split, split=split: in_split == split)
+            .map(lambda wav, target, in_split: {'audio': wav, 'label': target})
+            for split in ['train', 'validation', 'eval']}
+
+def bench_split(work_dir, repeats):
+    """ One epoch over the train, validation and eval splits of data.load, against filtering one decoded pipeline.
+
+    Reports the wall time and bytes read per epoch of each, over a corpus of a few thousand short clips.
+    """
+    from data import dataset_classes, load, load_metadata
+
+    classes, _, _ = dataset_classes()
+    corpus = os.path.join(work_dir, 'corpus') + '/'
+    audio_seconds = generate_corpus(corpus, classes, SPLIT_CLIPS_PER_CLASS, seconds=SPLIT_SECONDS)
+    metadata, new_classes = load_metadata(corpus)
+    clips = len(metadata)
+
+    def epoch(datasets):
+        start = read_bytes()
+        count = sum(1 for split in datasets.values() for _ in split)
+        end = read_bytes()
+        return count, None if start is None else end - start
+
+    results = {}
+    for name, build in [('filtered', lambda: filtered_splits(metadata, len(new_classes))),
+                        ('per_split', lambda: load(corpus, rescan=False)[0])]:
+        datasets = build()
+        (count, read), timing = timed(lambda: epoch(datasets), repeats)
+        timing.update({'clips': count, 'read_bytes_per_epoch': read})
+        results[f'data.load/{name}'] = throughput(timing, audio_seconds, 'audio_seconds')
+    print(f'  {clips} clips, per-split reads '
+          f"{results['data.load/per_split']['read_bytes_per_epoch']} vs filtered "
+          f"{results['data.load/filtered']['read_bytes_per_epoch']} bytes per epoch")
+    return results
+
+def bench_embedding(work_dir, repeats):
+    """ data.load with an embedding store over a synthetic corpus: a cold run embeds every clip, a warm run none. """
+    from data import dataset_classes, load
+    from embedding_store import EmbeddingStore
+    from main import embed_file
+    import main
+    from models import import_model
+
+    classes, _, _ = dataset_classes()
+    corpus = os.path.join(work_dir, 'corpus') + '/'
+    audio_seconds = generate_corpus(corpus, classes)
+    main.yamnet_model, _ = import_model('yamnet')
+
+    def run(store):
+        datasets, _ = load(corpus, store=store)
+        return sum(len(embeddings) for split in datasets.values() for embeddings, _ in split.as_numpy_iterator())
+
+    store_dir = os.path.join(work_dir, 'embeddings')
+    frames, cold = timed(lambda: run(EmbeddingStore(store_dir, embed_fn=embed_file)), 1)
+    _, warm = timed(lambda: run(EmbeddingStore(store_dir, embed_fn=embed_file)), repeats)
+    cold['frames'] = warm['frames'] = frames
+    return {
+        'data.load+embedding/cold': throughput(cold, audio_seconds, 'audio_seconds'),
+        'data.load+embedding/warm': throughput(warm, audio_seconds, 'audio_seconds'),
+    }
+
+def bench_head(work_dir, repeats):
+    """ head_trainer.fit_head for HEAD_EPOCHS epochs over synthetic, separable frame embeddings. """
+    from data import dataset_classes
+    from head_trainer import fit_head
+    from models import model
+
+    _, _, new_classes = dataset_classes()
+    rng = np.random.default_rng(SEED)
+    centers = rng.standard_normal((len(new_classes), 1024)).astype(np.float32)
+
+    def split(frames):
+        targets = rng.integers(len(new_classes), size=frames)
+        embeddings = centers[targets] + rng.standard_normal((frames, 1024)).astype(np.float32)
+        return embeddings, np.eye(len(new_classes), dtype=np.float32)[targets]
+
+    train = split(HEAD_FRAMES)
+    validation = split(HEAD_FRAMES // 10)
+    ckpt_path = os.path.join(work_dir, 'checkpoint')
+    _, timing = timed(lambda: fit_head(model(new_classes), train, validation, ckpt_path, max_epochs=HEAD_EPOCHS,
+                                       patience=HEAD_EPOCHS, verbose=0), repeats)
+    return {'head_trainer.fit_head': throughput(timing, HEAD_FRAMES * HEAD_EPOCHS, 'frames')}
+
+def bench_inference(work_dir, repeats, model_path):
+    """ SavedModel and TFLite backends over synthetic 16 kHz clips, one clip per call. """
+    from certificate.backends import load_backend
+
+    rng = np.random.default_rng(SEED)
+    clips = [synthetic_audio(rng, CORPUS_SECONDS[i % len(CORPUS_SECONDS)], 16000) for i in range(INFERENCE_CLIPS)]
+
+    results = {}
+    preds = {}
+    for name in ['saved_model', 'tflite']:
+        backend = load_backend(name, model_path)
+        backend(clips[0])
+        preds[name], timing = timed(lambda: [int(np.argmax(backend(clip))) for clip in clips], repeats)
+        timing['ms_per_clip'] = timing['seconds'] / len(clips) * 1000
+        results[f'inference/{name}'] = throughput(timing, len(clips), 'clips')
+    results['inference/tflite']['agreement'] = float(np.mean(np.array(preds['saved_model']) == np.array(preds['tflite'])))
+    return results
+
+def startup_seconds(code, paths, repeats):
+    """ Median seconds of code in fresh interpreters with paths first on sys.path, and whether it imported TensorFlow. """
+    script = (f'import sys, time; sys.path[:0] = {paths!r}; start = time.perf_counter(); {code}; '
+              f'print(time.perf_counter() - start, "tensorflow" in sys.modules)')
+    times = []
+    imports_tensorflow = False
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True).stdout
+        seconds, imports_tensorflow = output.split()[-2:]
+        times.append(float(seconds))
+    return {'seconds': statistics.median(times), 'min_seconds': min(times), 'repeats': repeats,
+            'imports_tensorflow': imports_tensorflow == 'True'}
+
+def bench_startup(work_dir, repeats):
+    """ Cold import time of each entry point and of loading the local YAMNet bundle, each in a fresh interpreter.
+
+    An entry point whose dependencies are not installed is left out of the results.
+    """
+    root = os.path.dirname(os.path.abspath(__file__))
+    certificate = os.path.join(root, 'certificate')
+    entry_points = {
+        'main': ('import main', [root]),
+        'hypnogram': ('import hypnogram', [root]),
+        'models': ('import models', [root]),
+        'embedding_store': ('import embedding_store', [root]),
+        'vad': ('import vad', [root]),
+        'timeline': ('import timeline', [root]),
+        'segments': ('import segments', [root]),
+        'audio_cache': ('import audio_cache', [root]),
+        'certificate.metadata': ('import metadata', [certificate]),
+        'certificate.trimmer': ('import trimmer', [certificate]),
+        'certificate.inference': ('import inference', [certificate, root]),
+        'certificate.server': ('import server', [certificate, root]),
+        'yamnet_bundle': ('import models; models.import_model("yamnet")', [root]),
+    }
+    results = {}
+    for name, (code, paths) in entry_points.items():
+        try:
+            results[f'startup/{name}'] = startup_seconds(code, paths, repeats)
+        except subprocess.CalledProcessError as e:
+            print(f'  startup/{name}: failed ({e.stderr.strip().splitlines()[-1] if e.stderr.strip() else e})')
+    return results
+
+BENCHMARKS = {
+    'startup': bench_startup,
+    'metadata': bench_metadata,
+    'trimmer': bench_trimmer,
+    'resample': bench_resample,
+    'split': bench_split,
+    'embedding': bench_embedding,
+    'head': bench_head,
+    'inference': bench_inference,
+}
+
+
+def run(results_path, only=None, model_path=None, repeats=REPEATS):
+    """ Run the benchmarks (all, or the names in only) and save their timings to results_path as JSON.
+
+    A benchmark whose dependencies are missing (ffmpeg, TensorFlow, an exported model) is recorded as skipped.
+    """
+    results = {
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'platform': {'python': platform.python_version(), 'machine': platform.machine(), 'cpus': os.cpu_count()},
+        'benchmarks': {},
+        'skipped': {},
+    }
+    work_dir = tempfile.mkdtemp(prefix='benchmark-')
+    try:
+        for name, bench in BENCHMARKS.items():
+            if only and name not in only:
+                continue
+            if name == 'inference' and model_path is None:
+                results['skipped'][name] = 'no exported model given, see --model'
+                continue
+            print(f'{name}...')
+            bench_dir = os.path.join(work_dir, name)
+            os.makedirs(bench_dir)
+            try:
+                args = (model_path,) if name == 'inference' else ()
+                timings = bench(bench_dir, repeats, *args)
+            except ImportError as e:
+                results['skipped'][name] = str(e)
+                continue
+            for key, timing in timings.items():
+                print(f"  {key}: {timing['seconds']:.3f}s")
+            results['benchmarks'].update(timings)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(results_path, 'w') as f:
+        json.dump(results, f, indent=2)
+    for name, reason in results['skipped'].items():
+        print(f'{name}: skipped ({reason})')
+    return results
+
+def compare(baseline_path, results_path, threshold=THRESHOLD):
+    """ Print each benchmark's time against the baseline, flagging the ones more than threshold slower.
+
+    Returns the names of the regressions.
+    """
+    with open(baseline_path) as f:
+        baseline = json.load(f)['benchmarks']
+    with open(results_path) as f:
+        current = json.load(f)['benchmarks']
+
+    regressions = []
+    for name in sorted(set(baseline) & set(current)):
+        ratio = current[name]['seconds'] / baseline[name]['seconds'] if baseline[name]['seconds'] else 1.0
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        elif ratio < 1 - threshold:
+            flag = '  improved'
+        print(f"{name}: {baseline[name]['seconds']:.3f}s -> {current[name]['seconds']:.3f}s ({ratio:.2f}x){flag}")
+    for name in sorted(set(baseline) ^ set(current)):
+        print(f"{name}: only in {'baseline' if name in baseline else 'results'}")
+    return regressions
+
+
+if __name__ == '__main__':
+    # python benchmark.py run <results.json> [--only metadata,trimmer,...] [--model <serving model dir>]
+    # python benchmark.py compare <baseline.json> <results.json> [--threshold 0.1]
+    # python benchmark.py generate <dir> - write the synthetic corpus, PSG TSV and recording without timing them
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run')
+    run_parser.add_argument('results')
+    run_parser.add_argument('--only', type=lambda names: names.split(','))
+    run_parser.add_argument('--model')
+    run_parser.add_argument('--repeats', type=int, default=REPEATS)
+    compare_parser = commands.add_parser('compare')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('results')
+    compare_parser.add_argument('--threshold', type=float, default=THRESHOLD)
+    generate_parser = commands.add_parser('generate')
+    generate_parser.add_argument('dir')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        run(args.results, args.only, args.model, args.repeats)
+    elif args.command == 'compare':
+        sys.exit(1 if compare(args.baseline, args.results, args.threshold) else 0)
+    else:
+        from data import dataset_classes
+
+        classes, _, _ = dataset_classes()
+        print(f"{generate_corpus(os.path.join(args.dir, 'corpus'), classes):.0f}s of audio in {args.dir}/corpus")
+        generate_tsv(os.path.join(args.dir, 'go001_1.tsv'))
+        print(f'{TSV_EVENTS} events in {args.dir}/go001_1.tsv')
+        audio_name, csv_name = generate_recording(args.dir)
+        print(f'{RECORDING_SECONDS}s recording {audio_name} annotated by {csv_name} in {args.dir}')
@@ -0,0 +1,97 @@
+import os
+import threading
+
+import numpy as np
+
+import tensorflow as tf
+
+from batched_yamnet import pad_batch
+from tflite_coverter import dequantize_output, quantize_input
+
+
+TFLITE_MODEL = 'converted_model.tflite'
+# the serving_batch signature on its own, next to TFLITE_MODEL - see tflite_coverter.export_tflite_batch
+TFLITE_BATCH_MODEL = 'converted_model_batch.tflite'
+
+
+class SavedModelBackend:
+    """ Class logits of one 16 kHz waveform, or of a list of them, from the exported serving SavedModel.
+
+    batch scores the whole list in one call of the serving_batch signature. A model exported without it falls back to
+    one call per clip.
+    """
+
+    def __init__(self, saved_model_path):
+        self.model = tf.saved_model.load(saved_model_path)
+        self.batch_signature = self.model.signatures.get('serving_batch')
+
+    def __call__(self, wav):
+        return self.model(wav).numpy()
+
+    def batch(self, wavs):
+        """ (clips, classes) logits of a list of 16 kHz waveforms of any lengths. """
+        if self.batch_signature is None:
+            return np.stack([self(wav).reshape(-1) for wav in wavs])
+        waveforms, lengths = pad_batch(wavs)
+        return self.batch_signature(audio=tf.constant(waveforms), lengths=tf.constant(lengths))['classifier'].numpy()
+
+
+class TFLiteBackend:
+    """ Class logits of one 16 kHz waveform from converted_model.tflite, or of a list of them.
+
+    batch scores the whole list in one call of converted_model_batch.tflite next to it, or one call per clip if
+    there is none. An interpreter is not thread-safe, so every worker thread lazily gets its own ones.
+    The input is resized to the clip length, tensors are only reallocated when that length changes.
+    """
+
+    def __init__(self, tflite_path, num_threads=1):
+        if os.path.isdir(tflite_path):
+            tflite_path = os.path.join(tflite_path, TFLITE_MODEL)
+        self.tflite_path = tflite_path
+        self.batch_path = os.path.join(os.path.dirname(tflite_path), TFLITE_BATCH_MODEL)
+        if not os.path.isfile(self.batch_path):
+            self.batch_path = None
+        self.num_threads = num_threads
+        self._local = threading.local()
+
+    def interpreter(self):
+        if getattr(self._local, 'interpreter', None) is None:
+            self._local.interpreter = tf.lite.Interpreter(model_path=self.tflite_path, num_threads=self.num_threads)
+            self._local.length = None
+        return self._local.interpreter
+
+    def __call__(self, wav):
+        interpreter = self.interpreter()
+        input_details = interpreter.get_input_details()[0]
+        output_details = interpreter.get_output_details()[0]
+        if self._local.length != len(wav):
+            interpreter.resize_tensor_input(input_details['index'], [len(wav)], strict=False)
+            interpreter.allocate_tensors()
+            self._local.length = len(wav)
+        # a full-integer (int8) model takes and returns int8
+        interpreter.set_tensor(input_details['index'], quantize_input(input_details, wav))
+        interpreter.invoke()
+        return dequantize_output(output_details, interpreter.get_tensor(output_details['index']))
+
+    def batch_runner(self):
+        if getattr(self._local, 'batch_runner', None) is None:
+            interpreter = tf.lite.Interpreter(model_path=self.batch_path, num_threads=self.num_threads)
+            # the runner resizes its inputs to each batch's shape
+            self._local.batch_runner = interpreter.get_signature_runner('serving_batch')
+        return self._local.batch_runner
+
+    def batch(self, wavs):
+        """ (clips, classes) logits of a list of 16 kHz waveforms of any lengths. """
+        if self.batch_path is None:
+            return np.stack([self(wav).reshape(-1) for wav in wavs])
+        waveforms, lengths = pad_batch(wavs)
+        return self.batch_runner()(audio=waveforms, lengths=lengths)['classifier']
+
+
+BACKENDS = {
+    'saved_model': SavedModelBackend,
+    'tflite': TFLiteBackend,
+}
+
+def load_backend(name, model_path):
+    return BACKENDS[name](model_path)
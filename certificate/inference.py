@@ -1,29 +1,110 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+from backends import load_backend
 from data import load_certificate, load_wav_16k_mono
+import profiling
+from profiling import StageTimer, peak_rss_mb
+from vad import DECISION_CLASS, SilenceFilter
 
 import tensorflow as tf
 
 
-def inference():
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+# clips scored by one model call, and batches in flight at once
+BATCH_SIZE = 16
+MODEL_WORKERS = os.cpu_count()
+
+SLEEP_SCORING_PATH = 'C:/Users/AllyHyeseongKim/PycharmProjects/Sleep-Stage-Classification/certificate/dataset/audio/'
+SAVED_MODEL_PATH = '../results/sleep_sound_model/class 4/sample'
+
+
+def decode_pipeline(filenames):
+    """ Decode and resample the clips in parallel, in order, ahead of the model. """
+    dataset = tf.data.Dataset.from_tensor_slices(filenames)
+    dataset = dataset.map(load_wav_16k_mono, num_parallel_calls=AUTOTUNE, deterministic=True)
+    return dataset.prefetch(AUTOTUNE)
+
+def batches(dataset, timer, batch_size=BATCH_SIZE):
+    """ Group decoded waveforms into lists of batch_size, timing how long the model side waits on decoding. """
+    iterator = iter(dataset)
+    batch = []
+    while True:
+        start = time.perf_counter()
+        try:
+            wav = next(iterator)
+        except StopIteration:
+            break
+        timer.record('decode', time.perf_counter() - start)
+        batch.append(wav)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def run(backend, filenames, timer, batch_size=BATCH_SIZE, workers=MODEL_WORKERS, silence_filter=None):
+    """ Predicted class id of every file, in order.
+
+    Each batch of clips is one backend.batch call (the serving_batch signature), up to workers batches run at once
+    while the next ones decode. With a vad.SilenceFilter a clip that is silence throughout is DECISION_CLASS without
+    running the backend.
+    """
+    def predict(batch):
+        wavs = [wav.numpy() for wav in batch]
+        silent = [False] * len(wavs)
+        if silence_filter is not None:
+            start = time.perf_counter()
+            silent = [silence_filter.decide(wav) for wav in wavs]
+            timer.record('vad', time.perf_counter() - start, items=len(wavs))
+        voiced = [i for i, is_silent in enumerate(silent) if not is_silent]
+        preds = [DECISION_CLASS] * len(wavs)
+        if voiced:
+            start = time.perf_counter()
+            logits = backend.batch([wavs[i] for i in voiced])
+            timer.record('model', time.perf_counter() - start, items=len(voiced))
+            for i, clip_logits in zip(voiced, logits):
+                preds[i] = int(np.argmax(clip_logits))
+        return preds
+
+    preds = []
+    in_flight = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch in batches(decode_pipeline(filenames), timer, batch_size):
+            profiling.step()
+            in_flight.append(executor.submit(predict, batch))
+            if len(in_flight) >= workers:
+                preds += in_flight.popleft().result()
+        while in_flight:
+            preds += in_flight.popleft().result()
+    return preds
+
+def inference(backend='saved_model', model_path=SAVED_MODEL_PATH, vad=False):
     true = 0
     false = 0
-    flag = true
     result_csv_path = "./result.csv"
-    new = open(result_csv_path, "a")
-    new.write("filename,ground truth,predicted,result\n")
 
-    sleep_scoring_path = 'C:/Users/AllyHyeseongKim/PycharmProjects/Sleep-Stage-Classification/certificate/dataset/audio/'
-    dataset, map_classes = load_certificate(path=sleep_scoring_path)
+    # PROFILE_REPORT=<report.json> saves the stage timings below, PROFILE_TRACE=<log dir> traces PROFILE_STEPS batches
+    profile = profiling.enable_from_env()
+
+    dataset, map_classes = load_certificate(path=SLEEP_SCORING_PATH)
     print(dataset)
 
-    saved_model_path = '../results/sleep_sound_model/class 4/sample'
-    saved_model = tf.saved_model.load(saved_model_path)
+    backend = load_backend(backend, model_path)
 
-    for test_data in dataset.to_numpy():
-        filename = test_data[0]
-        label = int(test_data[2])
-        wav = load_wav_16k_mono(filename)
-        model_result = saved_model(wav)
-        pred = tf.argmax(model_result).numpy()
+    timer = profile.timer if profile is not None else StageTimer()
+    test_data = dataset.to_numpy()
+    silence_filter = SilenceFilter('decision') if vad else None
+    preds = run(backend, [str(filename) for filename in test_data[:, 0]], timer, silence_filter=silence_filter)
+
+    lines = ["filename,ground truth,predicted,result\n"]
+    for (filename, _, label), pred in zip(test_data, preds):
+        label = int(label)
 
         if label == pred:
             true += 1
@@ -33,12 +114,53 @@ def inference():
             flag = "false"
 
         filename = "/".join(filename.split("/")[-2:])
-        new.write(filename + "," + map_classes[label] + "," + map_classes[pred] + "," + flag + "\n")
+        lines.append(filename + "," + map_classes[label] + "," + map_classes[pred] + "," + flag + "\n")
 
     accuracy = true/(true+false)*100
     print(f"Test Accuracy: {accuracy}%")
-    new.write("\n")
-    new.write("\n")
-    new.write("result," + str(accuracy) + "%\n")
+    lines.append("\n")
+    lines.append("\n")
+    lines.append("result," + str(accuracy) + "%\n")
+
+    with timer.stage('write', items=len(preds)):
+        with open(result_csv_path, "a") as new:
+            new.writelines(lines)
+
+    print(timer.summary(items=len(preds)))
+    if silence_filter is not None:
+        print(silence_filter.report())
+    profiling.save_report()
+
+def measure(backend, model_path, filenames):
+    """ Predictions, latency, throughput and peak RSS of one backend over filenames. """
+    timer = StageTimer()
+    with timer.stage('load'):
+        backend = load_backend(backend, model_path)
+    preds = run(backend, filenames, timer)
+    model = timer.stages['model']
+    return {
+        'preds': preds,
+        'load_s': timer.stages['load']['seconds'],
+        'latency_ms': model['seconds'] / model['items'] * 1000,
+        'files_per_s': len(filenames) / timer.elapsed(),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+def compare(model_path=SAVED_MODEL_PATH):
+    """ Run the SavedModel and its converted_model.tflite over the certificate set and report how they differ. """
+    dataset, map_classes = load_certificate(path=SLEEP_SCORING_PATH)
+    filenames = [str(filename) for filename in dataset['filename']]
+
+    results = {}
+    for backend in ['saved_model', 'tflite']:
+        # a fresh process per backend, so peak RSS only counts that backend - spawned, TensorFlow is already imported
+        # here and its thread pools do not survive a fork
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            results[backend] = executor.submit(measure, backend, model_path, filenames).result()
 
-    new.close()
+    agreement = np.mean(np.array(results['saved_model']['preds']) == np.array(results['tflite']['preds'])) * 100
+    for backend, result in results.items():
+        print(f"{backend}: load {result['load_s']:.2f}s, {result['latency_ms']:.2f} ms/clip, "
+              f"{result['files_per_s']:.2f} files/s, peak RSS {result['peak_rss_mb']:.0f} MiB")
+    print(f"Prediction agreement: {agreement:.2f}% of {len(filenames)} files")
+    return results, agreement
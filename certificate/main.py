@@ -1,6 +1,12 @@
-from inference import inference
-
-if __name__ == "__main__":
-    inference()
+import sys
 
+from inference import compare, inference
 
+if __name__ == "__main__":
+    # python main.py [saved_model|tflite|compare] [--vad]
+    mode = sys.argv[1] if len(sys.argv) > 1 and sys.argv[1] != '--vad' else 'saved_model'
+    if mode == 'compare':
+        compare()
+    else:
+        # --vad: clips that are silence throughout are scored wake without running the model
+        inference(backend=mode, vad='--vad' in sys.argv[1:])
@@ -1,8 +1,14 @@
 import csv
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from datetime import timedelta
+from itertools import repeat
+import os
 import re
 import sys
+import time
+
+import numpy as np
+import pandas as pd
 
 # Known events and corresponding integer codes
 EVENT_CODE = {
@@ -111,6 +117,62 @@ def convert_time(date_string, time_string):
     return return_value
 
 
+# Format a column of Korean times into datetime64[s] on date_string, same rules as convert_time
+# "[오전 |오후 ]H:MM:SS" or "HH:MM:SS" is parsed on the code points of all rows at once, anything else row by row
+def convert_times(date_string, time_strings):
+    # Extract date from string
+    date = date_string.split("-")
+    base = np.datetime64(datetime(year=int(date[0]), month=int(date[1]), day=int(date[2])), "s")
+
+    text = np.array(time_strings, dtype=str)
+    count = len(text)
+    if count == 0:
+        return np.array([], dtype="datetime64[s]")
+    width = max(text.dtype.itemsize // 4, 9)
+    codes = np.zeros((count, width), dtype=np.int64)
+    codes[:, :text.dtype.itemsize // 4] = text.view(np.uint32).reshape(count, -1)
+    length = (codes != 0).sum(axis=1)
+    rows = np.arange(count)
+
+    # Hour conversion :
+    # 오전 12시 -> 0
+    # 오후 1시 -> 13
+    spaced = codes[:, 2] == ord(" ")
+    morning = (codes[:, 0] == ord("오")) & (codes[:, 1] == ord("전")) & spaced
+    afternoon = (codes[:, 0] == ord("오")) & (codes[:, 1] == ord("후")) & spaced
+    prefix = np.where(morning | afternoon, 3, 0)
+    hour_digits = length - 6 - prefix
+
+    def digit(position):
+        return codes[rows, np.clip(position, 0, width - 1)] - ord("0")
+
+    digits = [digit(prefix), digit(prefix + 1), digit(length - 5), digit(length - 4), digit(length - 2), digit(length - 1)]
+    valid = ((hour_digits == 1) | (hour_digits == 2)) & \
+            (codes[rows, np.clip(length - 3, 0, width - 1)] == ord(":")) & \
+            (codes[rows, np.clip(length - 6, 0, width - 1)] == ord(":"))
+    for position, value in enumerate(digits):
+        if position == 1:
+            # second hour digit only exists for two-digit hours
+            valid &= (hour_digits == 1) | ((value >= 0) & (value <= 9))
+        else:
+            valid &= (value >= 0) & (value <= 9)
+
+    hour = np.where(hour_digits == 2, digits[0] * 10 + digits[1], digits[0])
+    hour = np.where(morning & (hour == 12) & (hour_digits == 2), 0, hour)
+    hour = np.where(afternoon & ~((hour == 12) & (hour_digits == 2)), hour + 12, hour)
+
+    # Minute/second parse
+    minute = digits[2] * 10 + digits[3]
+    second = digits[4] * 10 + digits[5]
+    valid &= (hour <= 23) & (minute <= 59) & (second <= 59)
+
+    # Return - rows off the common format go through convert_time, with its errors
+    return_value = base + np.where(valid, hour * 3600 + minute * 60 + second, 0).astype("timedelta64[s]")
+    for i in np.flatnonzero(~valid):
+        return_value[i] = np.datetime64(convert_time(date_string, str(text[i])), "s")
+    return return_value
+
+
 # Check date validity by splitting and casting to integer
 def check_date_valid(string):
     tmp = string.split("-")
@@ -134,23 +196,49 @@ def check_device_valid(string):
     return False
 
 
-# Each row's info of the tsv file is stored using Iter
-# get_row returns a string in csv row format
-class Iter:
-    def __init__(self, device, trial, sleep_stage, full_time, event, duration):
+# Rows of the tsv file are stored column-wise in EventTable, one array per csv column
+# get_rows returns the rows as strings in csv row format
+class EventTable:
+    def __init__(self, device, trial, sleep_stage, time, event, event_id, duration):
         self.device = device
         self.trial = int(trial)
-        self.sleep_stage = EVENT_CODE[sleep_stage]
-        self.time = full_time
-        self.event_id = EVENT_CODE[event]
-        if event == "SNORE-SINGLE":
-            event = "SNORE"
-        self.event = event
-        self.duration = int(duration)
+        self.sleep_stage = np.asarray(sleep_stage, dtype=np.int64)
+        self.time = np.asarray(time, dtype="datetime64[s]")
+        self.event = np.asarray(event, dtype=object)
+        self.event_id = np.asarray(event_id, dtype=np.int64)
+        self.duration = np.asarray(duration, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.time)
+
+    def end(self):
+        return self.time + self.duration.astype("timedelta64[s]")
+
+    def take(self, indices):
+        return EventTable(self.device, self.trial, self.sleep_stage[indices], self.time[indices], self.event[indices],
+                          self.event_id[indices], self.duration[indices])
+
+    def concat(self, other):
+        return EventTable(self.device, self.trial, np.concatenate([self.sleep_stage, other.sleep_stage]),
+                          np.concatenate([self.time, other.time]), np.concatenate([self.event, other.event]),
+                          np.concatenate([self.event_id, other.event_id]), np.concatenate([self.duration, other.duration]))
+
+    def get_rows(self):
+        # "YYYY-MM-DDTHH:MM:SS" -> "YYYY-MM-DD HH:MM:SS", like str(datetime)
+        time_text = np.datetime_as_string(self.time, unit="s")
+        if len(time_text) != 0:
+            time_text.view(np.uint32).reshape(len(time_text), -1)[:, 10] = ord(" ")
+        return list(map(",".join, zip(repeat(str(self.device)), repeat(str(self.trial)), self.sleep_stage.astype(str).tolist(),
+                                      time_text.tolist(), self.event.astype(str).tolist(), self.event_id.astype(str).tolist(),
+                                      self.duration.astype(str).tolist())))
+
 
-    def get_row(self):
-        return str(self.device) + "," + str(self.trial) + "," + str(self.sleep_stage) + "," + str(self.time) + "," + \
-               str(self.event) + "," + str(self.event_id) + "," + str(self.duration)
+# Map event names to EVENT_CODE, raising KeyError on unknown events like a dict lookup
+def event_codes(events):
+    codes = pd.Series(events, dtype=object).map(EVENT_CODE)
+    if codes.isna().any():
+        raise KeyError(events[int(np.flatnonzero(codes.isna().to_numpy())[0])])
+    return codes.to_numpy(dtype=np.int64)
 
 
 #
@@ -160,29 +248,29 @@ def import_file(device, trial, date, init_date, file_name):
 
     # Init
     trimmed_content = trim_imported_tsv_content(imported_content)
-    container = []
 
     # Next day calculation
     offset = 0
     if len(trimmed_content) == 0:
-        return []
+        return EventTable(device, trial, [], [], [], [], [])
     if convert_time(date, trimmed_content[0][1]) < init_date:
         offset = 1
 
-    # Content iteration
-    for i in range(0, len(trimmed_content)):
-        item = trimmed_content[i]
+    # Columns
+    sleep_stage = [item[0] for item in trimmed_content]
+    time_text = [item[1] for item in trimmed_content]
+    event = np.array([item[2] for item in trimmed_content], dtype=object)
+    duration = np.array([item[3] for item in trimmed_content], dtype=str).astype(np.int64)
 
-        # Next day calculation
-        if 0 < i:
-            if trimmed_content[i - 1][1] > trimmed_content[i][1]:
-                offset += 1
+    # Next day calculation - a time string sorting before the previous one starts a new day
+    raw_time = np.array(time_text, dtype=str)
+    offset = offset + np.concatenate([[0], np.cumsum(raw_time[:-1] > raw_time[1:])])
 
-        iteration = Iter(device=device, trial=trial, sleep_stage=item[0],
-                         full_time=convert_time(date, item[1]) + timedelta(days=offset),
-                         event=item[2], duration=item[3])
-        container.append(iteration)
-    return container
+    event_id = event_codes(event)
+    event[event == "SNORE-SINGLE"] = "SNORE"
+    return EventTable(device=device, trial=trial, sleep_stage=event_codes(sleep_stage),
+                      time=convert_times(date, time_text) + offset.astype("timedelta64[D]"),
+                      event=event, event_id=event_id, duration=duration)
 
 
 def fetch_initial_data(tsv_name, wav_name):
@@ -226,95 +314,113 @@ def diff_datetime(first, second):
 
 
 def none_fill(array, global_info):
-    base_list = sorted(array, key=lambda iter: iter.time)
-    none_list = []
+    # Stable sort keeps rows with equal time in file order
+    base = array.take(np.argsort(array.time, kind="stable"))
 
     # Fill with none only if array is not empty:
-    if len(array) != 0:
-        # Add head none
-        # todo : muted - no global start of recording across recorded files
-        # if global_info["full_time"] < base_list[0].time:
-        #     none_list.append(Iter(device=global_info["device"], trial=global_info["trial"],sleep_stage="NONE",
-        #                           full_time=global_info["full_time"], event="NONE",
-        #                           duration=diff_datetime(base_list[0].time, global_info["full_time"]).seconds))
-
-        # Add consecutive nones
-        for i in range(0, len(base_list) - 1):
-            end_of_i = base_list[i].time + timedelta(seconds=base_list[i].duration)
-            if end_of_i < base_list[i + 1].time:
-                none_list.append(Iter(device=global_info["device"], trial=global_info["trial"],
-                                      sleep_stage="NONE", full_time=end_of_i,
-                                      event="NONE", duration=diff_datetime(base_list[i + 1].time, end_of_i).seconds))
-
-        # Add tail none
-        end_of_last_base = base_list[len(base_list) - 1].time + timedelta(
-            seconds=base_list[len(base_list) - 1].duration)
-        none_list.append(Iter(device=global_info["device"], trial=global_info["trial"], sleep_stage="NONE",
-                              full_time=end_of_last_base, event="NONE", duration=-1))
+    if len(base) == 0:
+        return base
+
+    # Add head none
+    # todo : muted - no global start of recording across recorded files
+
+    # Add consecutive nones - in one pass over the gaps between each end and the next start
+    end = base.end()
+    gap = end[:-1] < base.time[1:]
+    none_time = end[:-1][gap]
+    # timedelta.seconds of the gap, like diff_datetime(...).seconds
+    none_duration = (base.time[1:][gap] - none_time).astype(np.int64) % 86400
+
+    # Add tail none
+    none_time = np.concatenate([none_time, end[-1:]])
+    none_duration = np.concatenate([none_duration, [-1]])
+
+    count = len(none_time)
+    none_list = EventTable(device=global_info["device"], trial=global_info["trial"],
+                           sleep_stage=np.full(count, EVENT_CODE["NONE"]), time=none_time,
+                           event=np.full(count, "NONE", dtype=object), event_id=np.full(count, EVENT_CODE["NONE"]),
+                           duration=none_duration)
 
     # Return
-    return_list = base_list
-    for iter in none_list:
-        return_list.append(iter)
-    return_list = sorted(return_list, key=lambda iter: iter.time)
-    return return_list
+    return_list = base.concat(none_list)
+    return return_list.take(np.argsort(return_list.time, kind="stable"))
 
 
+# Rows overlapping their predecessor, in csv format
+# Candidates (end of i after start of i + 1) are found in one vectorized pass, only those positions are walked
 def overlap_analysis(array):
-    return_value = ""
-
+    count = len(array)
+    if count < 2:
+        return ""
+    end = array.end()
+    candidates = np.flatnonzero(end[:-1] > array.time[1:]).tolist()
+    start = array.time.astype(np.int64).tolist()
+    end = end.astype(np.int64).tolist()
+
+    indices = []
     i = 0
+    k = 0
     while True:
-        if len(array) - 1 < i + 1:
+        while k < len(candidates) and candidates[k] < i:
+            k += 1
+        if k == len(candidates):
             break
-        else:
-            start_time_1 = array[i].time
-            end_time_1 = start_time_1 + timedelta(seconds=array[i].duration)
-            start_time_2 = array[i + 1].time
-            if end_time_1 > start_time_2:
-                return_value += array[i].get_row() + "\n"
-                return_value += array[i + 1].get_row() + "\n"
-                j = 2
-                while True:
-                    if len(array) - 1 < i + j + 1:
-                        break
-                    start_time_loop = array[i + j].time
-                    if end_time_1 > start_time_loop:
-                        return_value += array[i + j].get_row() + "\n"
-                        j += 1
-                    else:
-                        i = i + j
-                        break
-
-            i += 1
-
-    return return_value
-
-
-# Good night, world!
-def convert(file_name, start_time):
+        i = candidates[k]
+
+        # i and i + 1 overlap, extend over following rows starting before the end of i
+        # the last row is never checked as an extension
+        indices += [i, i + 1]
+        j = 2
+        while True:
+            if count - 1 < i + j + 1:
+                break
+            if end[i] > start[i + j]:
+                indices.append(i + j)
+                j += 1
+            else:
+                i = i + j
+                break
+        i += 1
+
+    if len(indices) == 0:
+        return ""
+    return "".join(row + "\n" for row in array.take(np.array(indices, dtype=np.int64)).get_rows())
+
+
+# File name without its directory, for \ or / separated paths
+def short_name(file_name):
+    filename_split = file_name.replace("\\", "/").split("/")
+    return filename_split[len(filename_split) - 1]
+
+
+# Convert one tsv into (csv content, overlap rows)
+def convert_content(file_name, start_time):
     # CSV init
     export_value = FIRST_LINE + "\n"
 
-    filename_split = file_name.split("\\")
-    short_filename = filename_split[len(filename_split) - 1]
+    short_filename = short_name(file_name)
 
     # Input global information
     # Actual time not specified "Recording Date" of tsv - manual input required
     global_info = fetch_initial_data(short_filename, start_time)
 
     # Scan each file
-    compilation = []
-    compilation += import_file(device=global_info["device"], trial=global_info["trial"], date=global_info["date"],
-                               init_date=global_info["full_time"], file_name=file_name)
+    compilation = import_file(device=global_info["device"], trial=global_info["trial"], date=global_info["date"],
+                              init_date=global_info["full_time"], file_name=file_name)
 
     # Check for overlaps - BEFORE NONES ARE FILLED
     overlaps = overlap_analysis(compilation)
 
     # Fill gaps with event NONE
     none_filled = none_fill(array=compilation, global_info=global_info)
-    for item in none_filled:
-        export_value += item.get_row() + "\n"
+    export_value += "".join(row + "\n" for row in none_filled.get_rows())
+
+    return export_value, overlaps
+
+
+# Good night, world!
+def convert(file_name, start_time):
+    export_value, overlaps = convert_content(file_name, start_time)
 
     # Export file
     f = open("/certificate/dataset/go020_1_sleep scoring.csv", 'w')
@@ -331,10 +437,100 @@ def convert(file_name, start_time):
     return True
 
 
+# Output csv name of a tsv - device and trial from fetch_initial_data
+def output_name(file_name, start_time):
+    global_info = fetch_initial_data(short_name(file_name), start_time)
+    return global_info["device"] + "_" + str(global_info["trial"]) + "_sleep scoring.csv"
+
+
+# Convert one tsv of a batch into output_dir, returns its overlaps and timing
+def convert_to(file_name, start_time, output_dir):
+    start = time.time()
+    export_value, overlaps = convert_content(file_name, start_time)
+
+    output_path = os.path.join(output_dir, output_name(file_name, start_time))
+    f = open(output_path, 'w')
+    f.write(export_value)
+    f.close()
+
+    # annotated events only, not the NONE rows filling the gaps between them
+    event_column = FIRST_LINE.split(",").index("Event")
+    events = sum(1 for row in export_value.splitlines()[1:] if row.split(",")[event_column] != "NONE")
+    return {"file": file_name, "output": output_path, "events": events,
+            "overlaps": overlaps, "seconds": time.time() - start}
+
+
+# (tsv, start date) pairs of a batch - a tsv listing "tsv path<TAB>yyyyMMdd" per line,
+# or every tsv of a directory with the same start date
+def batch_pairs(source, start_time=None):
+    if os.path.isdir(source):
+        if start_time is None:
+            raise ValueError("a start date is needed to convert a directory")
+        return [(os.path.join(source, name), start_time) for name in sorted(os.listdir(source)) if name.endswith(".tsv")]
+    with open(source, "r", encoding="utf-8") as file:
+        return [(row[0], row[1]) for row in csv.reader(file, delimiter='\t') if len(row) >= 2]
+
+
+# Convert every (tsv, start date) pair across a process pool into output_dir
+# writes one csv per device/trial, a combined overlap report and a per-file timing log with the error of any tsv
+# that failed - the others still convert
+def convert_batch(pairs, output_dir, processes=None):
+    start = time.time()
+    os.makedirs(output_dir, exist_ok=True)
+
+    # two tsvs of one device/trial would overwrite each other
+    names = []
+    for file_name, start_time in pairs:
+        try:
+            names.append(output_name(file_name, start_time))
+        except Exception:
+            # a name that can not be parsed fails in convert_to, and is logged there
+            continue
+    duplicates = sorted(set(name for name in names if names.count(name) > 1))
+    if len(duplicates) != 0:
+        raise ValueError("more than one tsv converts to " + ", ".join(duplicates))
+
+    # a tsv that fails to convert is logged with its error, the rest of the batch still converts
+    results = []
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(convert_to, file_name, start_time, output_dir) for file_name, start_time in pairs]
+        for (file_name, _), future in zip(pairs, futures):
+            try:
+                result = future.result()
+            except Exception as error:
+                result = {"file": file_name, "output": "", "events": 0, "overlaps": "", "seconds": 0.0,
+                          "error": repr(error)}
+                print("failed " + file_name + " : " + repr(error))
+            results.append(result)
+
+    # Export combined overlaps - rows carry device and trial
+    f = open(os.path.join(output_dir, "cohort_overlap.csv"), 'w')
+    f.write(FIRST_LINE + "\n" + "".join(result["overlaps"] for result in results))
+    f.close()
+
+    # Export timing log - csv.writer quotes paths with commas
+    with open(os.path.join(output_dir, "conversion_log.csv"), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["File", "Output", "Events", "Overlap Rows", "Seconds", "Error"])
+        for result in results:
+            writer.writerow([result["file"], result["output"], result["events"], result["overlaps"].count("\n"),
+                             round(result["seconds"], 3), result.get("error", "")])
+
+    failed = sum(1 for result in results if "error" in result)
+    print("converted " + str(len(results) - failed) + " files in " + str(round(time.time() - start, 2)) + "s, " +
+          str(failed) + " failed")
+    return results
+
+
 # Standalone mode
 if __name__ == '__main__':
     # Check
 
+    if len(sys.argv) >= 4 and sys.argv[1] == "--batch":
+        # python metadata.py --batch <pairs.tsv | tsv directory> <output directory> [yyyyMMdd for a directory]
+        convert_batch(batch_pairs(sys.argv[2], sys.argv[4] if len(sys.argv) > 4 else None), sys.argv[3])
+        sys.exit(0)
+
     if len(sys.argv) == 3:
         manual = False
         file_name = sys.argv[1]
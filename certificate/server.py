@@ -0,0 +1,212 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+import numpy as np
+
+from backends import load_backend
+from data import dataset_classes, decode_wav_bytes_16k_mono
+from inference import SAVED_MODEL_PATH
+
+import tensorflow as tf
+
+
+PORT = 8080
+# largest micro-batch, and micro-batches running on the backend at once
+MAX_BATCH_SIZE = 16
+MODEL_WORKERS = os.cpu_count()
+# longest a request waits in the queue for others to join its batch
+MAX_WAIT_MS = 10
+# requests and batches the latency percentiles and mean batch size are computed over
+METRICS_WINDOW = 10000
+# clip length the model is warmed up with at startup
+WARMUP_SECONDS = 30
+
+
+class Metrics:
+    """ Thread-safe request latencies and batch sizes over the last METRICS_WINDOW requests and batches. """
+
+    def __init__(self, window=METRICS_WINDOW):
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=window)
+        self._batch_sizes = deque(maxlen=window)
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+
+    def record_request(self, seconds, ok=True):
+        with self._lock:
+            self.requests += 1
+            if ok:
+                self._latencies.append(seconds)
+            else:
+                self.errors += 1
+
+    def record_batch(self, size):
+        with self._lock:
+            self.batches += 1
+            self._batch_sizes.append(size)
+
+    def snapshot(self):
+        with self._lock:
+            latencies = np.array(self._latencies) * 1000
+            batch_sizes = np.array(self._batch_sizes)
+            snapshot = {'requests': self.requests, 'errors': self.errors, 'batches': self.batches}
+        snapshot['batch_size'] = {
+            'last': int(batch_sizes[-1]) if len(batch_sizes) else 0,
+            'mean': float(batch_sizes.mean()) if len(batch_sizes) else 0.0,
+            'max': int(batch_sizes.max()) if len(batch_sizes) else 0,
+        }
+        snapshot['latency_ms'] = {
+            'p50': float(np.percentile(latencies, 50)) if len(latencies) else 0.0,
+            'p99': float(np.percentile(latencies, 99)) if len(latencies) else 0.0,
+        }
+        return snapshot
+
+
+class MicroBatcher:
+    """ Merge concurrent requests into micro-batches for one backend.
+
+    A batch closes when it holds max_batch_size clips or when its oldest request has waited max_wait_ms, so waiting
+    for more requests adds at most max_wait_ms to any request. Each batch is one backend.batch call (the
+    serving_batch signature or the batch TFLite model). Up to workers batches run at once and the next batch is
+    collected while they do, so a slow batch only delays its own requests.
+    """
+
+    def __init__(self, backend, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS, workers=MODEL_WORKERS):
+        self.backend = backend
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.metrics = Metrics()
+        self._queue = queue.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        # a free worker - requests queue up into larger batches while every worker is busy
+        self._free_workers = threading.Semaphore(workers)
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def submit(self, wav):
+        """ Future of the class logits of one 16 kHz waveform. """
+        future = Future()
+        self._queue.put((time.perf_counter(), wav, future))
+        return future
+
+    def warmup(self, seconds=WARMUP_SECONDS):
+        """ Run a full batch of silent clips, so graph tracing and interpreter setup happen before serving. """
+        wav = np.zeros(seconds * 16000, dtype=np.float32)
+        for future in [self.submit(wav) for _ in range(self.max_batch_size)]:
+            future.result()
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = batch[0][0] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            # requests already queued always join, only waiting for new ones is bounded by the deadline
+            timeout = max(deadline - time.perf_counter(), 0)
+            try:
+                batch.append(self._queue.get(timeout=timeout) if timeout else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self, batch):
+        try:
+            logits = self.backend.batch([wav for _, wav, _ in batch])
+            for (_, _, future), clip_logits in zip(batch, logits):
+                future.set_result(clip_logits)
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+        finally:
+            self._free_workers.release()
+
+    def _loop(self):
+        while True:
+            self._free_workers.acquire()
+            batch = self._next_batch()
+            self.metrics.record_batch(len(batch))
+            self._executor.submit(self._run, batch)
+
+
+def handler(batcher, class_names):
+    """ Request handler class serving batcher: POST /predict with a WAV body, GET /metrics and GET /health. """
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def send_json(self, status, body):
+            body = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                metrics = batcher.metrics.snapshot()
+                metrics['queue_depth'] = batcher.queue_depth()
+                self.send_json(200, metrics)
+            elif self.path == '/health':
+                self.send_json(200, {'status': 'ok'})
+            else:
+                self.send_json(404, {'error': f'no such endpoint {self.path}'})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self.send_json(404, {'error': f'no such endpoint {self.path}'})
+                return
+            start = time.perf_counter()
+            try:
+                contents = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                wav = decode_wav_bytes_16k_mono(tf.constant(contents)).numpy()
+                logits = np.asarray(batcher.submit(wav).result()).reshape(-1)
+            except Exception as e:
+                batcher.metrics.record_request(time.perf_counter() - start, ok=False)
+                self.send_json(400, {'error': str(e)})
+                return
+            seconds = time.perf_counter() - start
+            batcher.metrics.record_request(seconds)
+            class_id = int(np.argmax(logits))
+            self.send_json(200, {
+                'class': class_names[class_id],
+                'class_id': class_id,
+                'logits': logits.tolist(),
+                'latency_ms': seconds * 1000,
+            })
+
+        def log_message(self, format, *args):
+            # one line per request would dominate a load test
+            pass
+
+    return Handler
+
+def serve(backend='saved_model', model_path=SAVED_MODEL_PATH, port=PORT, max_batch_size=MAX_BATCH_SIZE,
+          max_wait_ms=MAX_WAIT_MS):
+    _, _, class_names = dataset_classes()
+    batcher = MicroBatcher(load_backend(backend, model_path), max_batch_size, max_wait_ms)
+
+    start = time.perf_counter()
+    # decoding traces its own graph on the first upload
+    decode_wav_bytes_16k_mono(tf.audio.encode_wav(tf.zeros([16000, 1]), 16000))
+    batcher.warmup()
+    print(f'Warmed up in {time.perf_counter() - start:.2f}s')
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler(batcher, class_names))
+    print(f'Serving {backend} model {model_path} on http://127.0.0.1:{port}')
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    # python server.py [saved_model|tflite] [model path] [port]
+    backend = sys.argv[1] if len(sys.argv) > 1 else 'saved_model'
+    model_path = sys.argv[2] if len(sys.argv) > 2 else SAVED_MODEL_PATH
+    port = int(sys.argv[3]) if len(sys.argv) > 3 else PORT
+    serve(backend, model_path, port)
@@ -4,18 +4,24 @@ import ffmpeg
 
 import sys
 import os
-import librosa
 import csv
 import shutil
 from datetime import datetime
 from datetime import timedelta
-import asyncio
 import time
-import psutil
+import soundfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 
+# maximum number of ffmpegs running simultaneously
+MAX_WORKERS = os.cpu_count()
+
 # keep format of batch.tsv - full path of audio for column 1, full path of csv for column 2, use \ for path
 BATCH_FILE = "batch.tsv"
+# completed lines of a batch file go to <batch>.done.tsv, same format - they are skipped when the batch is resumed
+BATCH_DONE_SUFFIX = ".done.tsv"
+# subtype of a slice whose source subtype cannot be stored in a WAV file, e.g. an mp3 or ogg source
+FALLBACK_SUBTYPE = "FLOAT"
 
 
 # move file to location
@@ -29,45 +35,80 @@ def datetime_to_timestamp(title_time, target_datetime):
     diff = target_datetime - start_datetime
     return abs(diff.seconds)
 
-# slice source_path from start_timestamp to finish_timestamp and save to target_path
+# slices are written to a temporary name next to target_path and renamed once complete, so an existing target is
+# always a whole slice - an interrupted or failed slice never leaves a file that a resumed batch would skip
+def temp_path(target_path):
+    root, ext = os.path.splitext(target_path)
+    return root + ".part" + ext
+
+
+# remove the temporary file of a failed slice
+def discard(path):
+    if os.path.isfile(path):
+        os.remove(path)
+
+
+# slice source_path from start_timestamp to finish_timestamp and save to target_path, returns (succeeded, log line)
+# runs in a worker of the trimming pool and waits for its ffmpeg, so the pool size bounds concurrent ffmpegs
 def trim_wav(source_path, start_timestamp, finish_timestamp, target_path):
     # check if target file already exists -> doesn't exist
     if not os.path.isfile(target_path):
-        # check ffmpeg process count
-        while True:
-            ffmpeg_counter = 0
-            for proc in psutil.process_iter():
-                try:
-                    processName = proc.name()
-                    if processName == "ffmpeg.exe":
-                        ffmpeg_counter += 1
-                except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
-                    pass
-            # maximum of 8 ffmpegs may run simultaneously
-            if ffmpeg_counter > 7:
-                time.sleep(1)
-            else:
-                break
-
         # audio slice
+        part_path = temp_path(target_path)
         in_file = ffmpeg.input(source_path)
         audio_cut = in_file.audio.filter('atrim', start=start_timestamp, end=finish_timestamp)
-        audio_output = ffmpeg.output(audio_cut, target_path)
-        # waiting 0.2~0.5 seconds has positive impact on ffmpeg_async performance
-        time.sleep(0.1)
-        ffmpeg.run_async(audio_output, cmd=["ffmpeg", "-loglevel", "quiet", "-y"])
+        audio_output = ffmpeg.output(audio_cut, part_path)
+        process = ffmpeg.run_async(audio_output, cmd=["ffmpeg", "-loglevel", "quiet", "-y"])
+        exit_status = process.wait()
 
         # return log
-        return str(target_path + " : " + str(start_timestamp) + " ~ " + str(finish_timestamp) + "\n")
+        if exit_status != 0:
+            discard(part_path)
+            return False, str("failed " + target_path + " : " + str(start_timestamp) + " ~ " + str(finish_timestamp) +
+                              " with ffmpeg exit status " + str(exit_status) + "\n")
+        os.replace(part_path, target_path)
+        return True, str(target_path + " : " + str(start_timestamp) + " ~ " + str(finish_timestamp) + "\n")
     # check if target file already exists -> exists
     else:
         # return log
-        return str("skipping " + str(start_timestamp) + " ~ " + str(finish_timestamp) + " because file exists" + "\n")
+        return True, str("skipping " + str(start_timestamp) + " ~ " + str(finish_timestamp) + " because file exists" + "\n")
+
+
+# write every (start_timestamp, finish_timestamp, target_path) slice of source_path, reading the source once
+# slices are read in start order by sample offset - no ffmpeg process per event
+# slices are always WAV, in the source subtype when WAV supports it and FALLBACK_SUBTYPE otherwise
+# returns (succeeded, log line) per job, in job order
+def slice_wav(source_path, jobs):
+    results = {}
+    with soundfile.SoundFile(source_path) as source:
+        subtype = source.subtype if soundfile.check_format("WAV", source.subtype) else FALLBACK_SUBTYPE
+        for start_timestamp, finish_timestamp, target_path in sorted(jobs, key=lambda job: job[0]):
+            if os.path.isfile(target_path):
+                results[target_path] = True, str("skipping " + str(start_timestamp) + " ~ " + str(finish_timestamp) +
+                                                 " because file exists" + "\n")
+                continue
+            part_path = temp_path(target_path)
+            try:
+                start_frame = int(round(start_timestamp * source.samplerate))
+                finish_frame = int(round(finish_timestamp * source.samplerate))
+                source.seek(start_frame)
+                data = source.read(finish_frame - start_frame, dtype="int16" if subtype == "PCM_16" else "float32")
+                soundfile.write(part_path, data, source.samplerate, subtype=subtype, format="WAV")
+                os.replace(part_path, target_path)
+            except Exception as error:
+                discard(part_path)
+                results[target_path] = False, str("failed " + target_path + " : " + str(start_timestamp) + " ~ " +
+                                                  str(finish_timestamp) + " with " + repr(error) + "\n")
+                continue
+            results[target_path] = True, str(target_path + " : " + str(start_timestamp) + " ~ " + str(finish_timestamp) + "\n")
+
+    # return log in job order
+    return [results[target_path] for _, _, target_path in jobs]
 
 
 # uses source_audio_path, source_csv_path, line (of csv), counter (of events) to create an output path
 # event is overridden as none if force_none is True
-def path_calculator(source_audio_path, source_csv_path, line, counter, force_none=False):
+def path_calculator(source_audio_path, source_csv_path, line, counter, force_none=False, create_dirs=True):
     # determine event
     if force_none:
         event = "NONE"
@@ -80,7 +121,8 @@ def path_calculator(source_audio_path, source_csv_path, line, counter, force_non
     target_path = source_audio_path.replace(target_path[len(target_path) - 1], "") + "result\\" + target_path[
         len(target_path) - 1] + "-" + csv_path[len(csv_path) - 1]
     target_path = target_path + "\\" + event
-    os.makedirs(target_path, exist_ok=True)
+    if create_dirs:
+        os.makedirs(target_path, exist_ok=True)
 
     # audio format - uncomment following 4 lines to use original audio format
     out_format = "wav"
@@ -99,6 +141,11 @@ def path_calculator(source_audio_path, source_csv_path, line, counter, force_non
     target_audio_path = target_path + "\\" + target_name
     return target_audio_path
 
+# duration of an audio file in seconds - librosa takes seconds to import, so only when a file is trimmed
+def audio_duration(source_audio_path):
+    import librosa
+    return librosa.get_duration(filename=source_audio_path)
+
 # export log
 def write_log(text, source_audio_path, source_csv_path):
     target_path = source_audio_path.split("\\")
@@ -110,7 +157,9 @@ def write_log(text, source_audio_path, source_csv_path):
     f.write(text)
     f.close()
 
-def trim_file(source_audio_path, source_csv_path):
+# list every slice of source_audio_path annotated by source_csv_path as (start_timestamp, finish_timestamp, event, target_path)
+# slices whose start_timestamp is not before finish_timestamp are kept so they can be logged as skipped
+def plan_segments(source_audio_path, source_csv_path, create_dirs=True):
     # Fetch csv content
     result = []
     try:
@@ -155,25 +204,22 @@ def trim_file(source_audio_path, source_csv_path):
 
     # exit if csv has only one line(title row)
     if len(result) < 2:
-        return
+        return []
 
     # fetch audio duration
-    file_duration = librosa.get_duration(filename=source_audio_path)
+    file_duration = audio_duration(source_audio_path)
 
     # init
-    task_list = []
-    log_compilation = ""
+    jobs = []
 
     # First none
     line = result[1]
     finish_datetime = datetime.strptime(line[3], "%Y-%m-%d %H:%M:%S")
     finish_timestamp = datetime_to_timestamp(source_audio_time, finish_datetime)
     if finish_timestamp > 0:
-        target_audio_path = path_calculator(source_audio_path, source_csv_path, line, counter, force_none=True)
-        log_line = trim_wav(source_audio_path, 0, finish_timestamp, target_audio_path)
-        print(log_line, end = '')
-        log_compilation += log_line
-
+        target_audio_path = path_calculator(source_audio_path, source_csv_path, line, counter, force_none=True,
+                                            create_dirs=create_dirs)
+        jobs.append((0, finish_timestamp, "NONE", target_audio_path))
 
     # For each line of csv
     for i in range(1, len(result)):
@@ -184,7 +230,7 @@ def trim_file(source_audio_path, source_csv_path):
         finish_datetime = start_datetime + timedelta(seconds=duration)
 
         # Rename/move to appropriate directory
-        target_audio_path = path_calculator(source_audio_path, source_csv_path, line, counter)
+        target_audio_path = path_calculator(source_audio_path, source_csv_path, line, counter, create_dirs=create_dirs)
 
         # Datetime to timestamp
         start_timestamp = datetime_to_timestamp(source_audio_time, start_datetime)
@@ -192,15 +238,7 @@ def trim_file(source_audio_path, source_csv_path):
         if finish_timestamp > file_duration:
             finish_timestamp = file_duration
 
-        # Trim
-        if start_timestamp < finish_timestamp:
-            log_line = trim_wav(source_audio_path, start_timestamp, finish_timestamp, target_audio_path)
-            print(log_line, end = '')
-            log_compilation += log_line
-        else:
-            log_line = "skipping " + str(start_timestamp) + " ~ " + str(finish_timestamp) + " because start_timestamp is later than finish_timestamp or file_duration\n"
-            print(log_line, end = '')
-            log_compilation += log_line
+        jobs.append((start_timestamp, finish_timestamp, line[4], target_audio_path))
 
     # Last none
     line = result[len(result) - 1]
@@ -212,25 +250,120 @@ def trim_file(source_audio_path, source_csv_path):
     if file_duration > start_timestamp:
         finish_datetime = datetime.strptime(result[1][3], "%Y-%m-%d %H:%M:%S") + timedelta(seconds=file_duration)
         finish_timestamp = datetime_to_timestamp(source_audio_time, finish_datetime)
-        target_audio_path = path_calculator(source_audio_path, source_csv_path, line, counter, force_none=True)
-        log_line = trim_wav(source_audio_path, start_timestamp, finish_timestamp, target_audio_path)
+        target_audio_path = path_calculator(source_audio_path, source_csv_path, line, counter, force_none=True,
+                                            create_dirs=create_dirs)
+        jobs.append((start_timestamp, finish_timestamp, "NONE", target_audio_path))
+
+    return jobs
+
+
+# trim every annotated slice of source_audio_path and write log.txt
+# single_decode reads the source once and writes slices by sample offset, otherwise each slice is one ffmpeg
+# returns True only if every slice was written or already existed
+def trim_file(source_audio_path, source_csv_path, single_decode=False, workers=MAX_WORKERS):
+    jobs = plan_segments(source_audio_path, source_csv_path)
+    if len(jobs) == 0:
+        return True
+
+    valid = [(start, finish, target) for start, finish, _, target in jobs if start < finish]
+    if single_decode:
+        results = slice_wav(source_audio_path, valid)
+    else:
+        # bounded pool - each worker waits for its ffmpeg before taking the next slice
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(lambda job: trim_wav(source_audio_path, *job), valid))
+    log_lines = iter(log_line for _, log_line in results)
+
+    log_compilation = ""
+    for start_timestamp, finish_timestamp, _, _ in jobs:
+        if start_timestamp < finish_timestamp:
+            log_line = next(log_lines)
+        else:
+            log_line = "skipping " + str(start_timestamp) + " ~ " + str(finish_timestamp) + " because start_timestamp is later than finish_timestamp or file_duration\n"
         print(log_line, end = '')
         log_compilation += log_line
 
-
     write_log(log_compilation, source_audio_path, source_csv_path)
+    return all(succeeded for succeeded, _ in results)
+
+
+# read (audio path, csv path) pairs from a batch file, empty lines are ignored
+def read_batch(batch_file):
+    if not os.path.isfile(batch_file):
+        return []
+    with open(batch_file, "r", encoding="utf-8") as file:
+        return [(row[0], row[1]) for row in csv.reader(file, delimiter='\t') if len(row) >= 2]
+
+
+# trim one recording of a batch in a worker process, returns whether every slice succeeded, seconds of audio and
+# seconds taken
+def trim_recording(source_audio_path, source_csv_path, single_decode, workers):
+    start = time.time()
+    succeeded = trim_file(source_audio_path, source_csv_path, single_decode=single_decode, workers=workers)
+    return succeeded, audio_duration(source_audio_path), time.time() - start
+
+
+# trim every recording of batch_file across a process pool, recording each completed one in done_file
+# recordings already in done_file are skipped, so an interrupted batch resumes where it stopped
+# a recording with a failed slice is not done - the next run retries its missing slices
+def trim_batch(batch_file=BATCH_FILE, done_file=None, single_decode=False, processes=MAX_WORKERS):
+    start = time.time()
+    if done_file is None:
+        done_file = os.path.splitext(batch_file)[0] + BATCH_DONE_SUFFIX
+    done = set(read_batch(done_file))
+    pending = [pair for pair in read_batch(batch_file) if pair not in done]
+    print(str(len(done)) + " recordings already done, " + str(len(pending)) + " to go")
+
+    # each process gets its share of the cores for its own ffmpegs
+    workers = max(1, MAX_WORKERS // processes)
+    audio_seconds = 0
+    failed = []
+    with ProcessPoolExecutor(max_workers=processes) as executor, open(done_file, "a", encoding="utf-8") as done_log:
+        futures = {executor.submit(trim_recording, audio, csv_path, single_decode, workers): (audio, csv_path)
+                   for audio, csv_path in pending}
+        for future in as_completed(futures):
+            audio, csv_path = futures[future]
+            try:
+                succeeded, duration, seconds = future.result()
+            except Exception as error:
+                failed.append((audio, csv_path))
+                print("failed " + audio + " : " + repr(error))
+                continue
+            if not succeeded:
+                failed.append((audio, csv_path))
+                print("failed " + audio + " : some slices failed, see its log.txt")
+                continue
+            done_log.write(audio + "\t" + csv_path + "\n")
+            done_log.flush()
+            audio_seconds += duration
+            print("done " + audio + " in " + str(round(seconds, 1)) + "s")
+
+    # throughput summary
+    elapsed = time.time() - start
+    completed = len(pending) - len(failed)
+    print(str(completed) + " recordings (" + str(round(audio_seconds / 3600, 2)) + " h of audio) in " +
+          str(round(elapsed, 1)) + "s, " + str(round(completed / elapsed * 60, 2)) + " recordings/min, " +
+          str(round(audio_seconds / 3600 / (elapsed / 60), 2)) + " h of audio/min, " + str(len(failed)) + " failed")
+    return failed
 
 
 if __name__ == '__main__':
     # Check
-    if len(sys.argv) == 3:
+    if len(sys.argv) >= 2 and sys.argv[1] == "--batch":
+        # python trimmer.py --batch [batch.tsv] [--single-decode]
+        batch_file = sys.argv[2] if len(sys.argv) > 2 and not sys.argv[2].startswith("--") else BATCH_FILE
+        trim_batch(batch_file, single_decode="--single-decode" in sys.argv)
+        sys.exit(0)
+    if len(sys.argv) >= 3:
         manual = False
         wav_file = sys.argv[1]
         csv_file = sys.argv[2]
+        single_decode = "--single-decode" in sys.argv[3:]
     else:
         manual = True
         wav_file = input("wav path? : ")
         csv_file = input("csv path? : ")
+        single_decode = input("read source once instead of one ffmpeg per event? (y/n) : ") == "y"
 
-    print(trim_file(wav_file, csv_file))
+    print(trim_file(wav_file, csv_file, single_decode=single_decode))
 
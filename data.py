@@ -1,9 +1,12 @@
-import os
-
 import pandas as pd
 
+# the decoders are tf.functions defined at import, so loading data always imports TensorFlow
 import tensorflow as tf
-import tensorflow_io as tfio
+
+import profiling
+from manifest import load_manifest
+from resample import tf_resample
+from segments import SegmentReader
 
 
 TRAIN_RATIO = 0.8
@@ -11,23 +14,51 @@ VALIDATION_RATIO = 0.1
 TEST_RATIO = 0.1
 
 
+# audio_cache.AudioCache serving load_wav_16k_mono, see set_audio_cache
+_audio_cache = None
+
+
+def set_audio_cache(cache):
+    """ Read waveforms from a pre-resampled audio_cache.AudioCache, decoding live only on a cache miss. """
+    global _audio_cache
+    _audio_cache = cache
+
 @tf.function
-def load_wav_16k_mono(wav_path: str):
+def decode_wav_16k_mono(wav_path: str):
     """ Load a WAV file, convert it to a float tensor, resample to 16 kHz single-channel audio. """
     file_contents = tf.io.read_file(wav_path)
+    return decode_wav_bytes_16k_mono(file_contents)
+
+@tf.function(input_signature=[tf.TensorSpec(shape=[], dtype=tf.string)])
+def decode_wav_bytes_16k_mono(file_contents):
+    """ decode_wav_16k_mono of the bytes of a WAV file, e.g. an upload that never touches the disk. """
     wav, sample_rate = tf.audio.decode_wav(
         file_contents,
         desired_channels=1
     )
     wav = tf.squeeze(wav, axis=-1)
     sample_rate = tf.cast(sample_rate, dtype=tf.int64)
-    wav = tfio.audio.resample(wav, rate_in=sample_rate, rate_out=16000)
+    wav = tf_resample(wav, rate_in=sample_rate, rate_out=16000)
     return wav
 
+def load_wav_16k_mono(wav_path: str):
+    """ 16 kHz single-channel waveform of a WAV file, from the audio cache if one is set. """
+    if _audio_cache is None:
+        return decode_wav_16k_mono(wav_path)
+
+    wav, hit = tf.numpy_function(_audio_cache.lookup, [wav_path], (tf.float32, tf.bool))
+    wav.set_shape([None])
+    hit.set_shape([])
+    return tf.cond(hit, lambda: wav, lambda: decode_wav_16k_mono(wav_path))
+
 def load_wav_for_map(filename: str, label, split):
     return (load_wav_16k_mono(filename), label, split)
 
-def load(path: str, dataset: str = 'sleep_scoring'):
+def load_wav_for_split_map(filename: str, label):
+    return {'audio': load_wav_16k_mono(filename), 'label': label}
+
+def dataset_classes(dataset: str = 'sleep_scoring'):
+    """ (source classes, source class -> target id, target class names) of a dataset. """
     if dataset == 'sleep_scoring':
         classes = ['NONE', 'SLEEP-REM', 'SLEEP-S0', 'SLEEP-S1', 'SLEEP-S2', 'SLEEP-S3']
         map_class_to_id = {'NONE': 0, 'SLEEP-REM': 3, 'SLEEP-S0': 0, 'SLEEP-S1': 1, 'SLEEP-S2': 2, 'SLEEP-S3': 2}
@@ -41,51 +72,84 @@ def load(path: str, dataset: str = 'sleep_scoring'):
 
         print(f'data.load else')
 
-    #map_split_to_id = {'train': 0, 'validation': 1, 'eval': 2}
+    return classes, map_class_to_id, new_classes
 
-    metadata = pd.DataFrame(columns=['filename', 'class', 'split'])
-    for class_name in classes:
-        tempdata = pd.DataFrame(columns=['filename', 'class', 'split'])
-        tempdata['filename'] = [path + class_name + '/' + dirs for dirs in os.listdir(path + class_name)]
-        tempdata['class'] = class_name
-        class_id = tempdata['class'].apply(lambda name: map_class_to_id[name])
-        tempdata = tempdata.assign(target=class_id)
-        num_train = int(len(tempdata) * TRAIN_RATIO)
-        num_validation = (len(tempdata) - num_train) // 2
-        tempdata['split'].loc[:num_train] = 'train'
-        tempdata['split'].loc[num_train:num_train + num_validation] = 'validation'
-        tempdata['split'].loc[num_train + num_validation:] = 'eval'
-        metadata = metadata.append(tempdata, ignore_index=True)
-
-    dataset = tf.data.Dataset.from_tensor_slices((metadata['filename'], tf.keras.utils.to_categorical(metadata['target'], len(new_classes)), metadata['split']))
-    #print(dataset)
-    dataset = dataset.map(load_wav_for_map)
+def load_metadata(path: str, dataset: str = 'sleep_scoring', rescan: bool = True):
+    classes, map_class_to_id, new_classes = dataset_classes(dataset)
 
+    #map_split_to_id = {'train': 0, 'validation': 1, 'eval': 2}
+
+    metadata = load_manifest(path, classes, map_class_to_id, TRAIN_RATIO, rescan=rescan)
+
+    return metadata, new_classes
+
+def load(path: str, dataset: str = 'sleep_scoring', store=None, rescan: bool = True, in_memory: bool = False):
+    """ Load the train/validation/eval splits of path.
+
+    Without a store each element is {'audio': 16 kHz waveform, 'label': one-hot}.
+    With an embedding_store.EmbeddingStore the store is updated for new or changed files first, and each element is
+    (frame embeddings, repeated one-hot label) streamed from the store, so YAMNet never runs on unchanged files again.
+    With in_memory each split is instead a single (embeddings, labels) pair of arrays holding all of its frames.
+    """
+    with profiling.stage('data.load/metadata'):
+        metadata, new_classes = load_metadata(path, dataset, rescan)
+
+    if store is not None:
+        with profiling.stage('data.load/store_update', items=len(metadata)):
+            entries = store.update(metadata)
+        splited_dataset = {}
+        for split in ['train', 'validation', 'eval']:
+            in_split = entries[(metadata['split'] == split).to_numpy()]
+            if in_memory:
+                splited_dataset[split] = store.arrays(in_split, len(new_classes))
+            else:
+                split_dataset = store.dataset(in_split, len(new_classes))
+                splited_dataset[split] = profiling.instrument(split_dataset, f'data.load/{split}')
+        return splited_dataset, new_classes
+
+    # split on the metadata first so each split only decodes its own files
+    labels = tf.keras.utils.to_categorical(metadata['target'], len(new_classes))
     splited_dataset = {}
-    train = dataset.filter(lambda wav, target, split: split == 'train')
-    validation = dataset.filter(lambda wav, target, split: split == 'validation')
-    eval = dataset.filter(lambda wav, target, split: split == 'eval')
-    splited_dataset['train'] = train.map(lambda wav, target, split: {'audio': wav, 'label': target})
-    splited_dataset['validation'] = validation.map(lambda wav, target, split: {'audio': wav, 'label': target})
-    splited_dataset['eval'] = eval.map(lambda wav, target, split: {'audio': wav, 'label': target})
+    for split in ['train', 'validation', 'eval']:
+        in_split = (metadata['split'] == split).to_numpy()
+        dataset = tf.data.Dataset.from_tensor_slices((metadata['filename'][in_split], labels[in_split]))
+        splited_dataset[split] = profiling.instrument(dataset.map(load_wav_for_split_map), f'data.load/{split}')
 
     return splited_dataset, new_classes
 
-def load_certificate(path):
+def load_certificate(path, rescan: bool = True):
+    classes, map_class_to_id, new_classes = dataset_classes()
+
+    # same manifest as data.load, the certificate set has no use for the split
+    metadata = load_manifest(path, classes, map_class_to_id, TRAIN_RATIO, rescan=rescan)
+    metadata = metadata[['filename', 'class', 'target']]
 
-    classes = ['NONE', 'SLEEP-REM', 'SLEEP-S0', 'SLEEP-S1', 'SLEEP-S2', 'SLEEP-S3']
-    map_class_to_id = {'NONE': 0, 'SLEEP-REM': 3, 'SLEEP-S0': 0, 'SLEEP-S1': 1, 'SLEEP-S2': 2, 'SLEEP-S3': 2}
-    new_classes = ['wake', 'light', 'deep', 'REM']
+    return metadata, new_classes
 
-    print(f'Sleep Scoring Classes: {new_classes}')
+def load_segments(index_path: str, dataset: str = 'sleep_scoring'):
+    """ Load the train/validation/eval splits from a segments.build_segment_index index instead of clip folders.
 
-    metadata = pd.DataFrame(columns=['filename', 'class'])
-    for class_name in classes:
-        tempdata = pd.DataFrame(columns=['filename', 'class'])
-        tempdata['filename'] = [path + class_name + '/' + dirs for dirs in os.listdir(path + class_name)]
-        tempdata['class'] = class_name
-        class_id = tempdata['class'].apply(lambda name: map_class_to_id[name])
-        tempdata = tempdata.assign(target=class_id)
-        metadata = metadata.append(tempdata, ignore_index=True)
+    Each segment is read as a slice of its memory-mapped source recording and resampled to 16 kHz, so the elements
+    are the same {'audio', 'label'} as data.load without any trimmed clip files on disk.
+    """
+    classes, map_class_to_id, new_classes = dataset_classes(dataset)
 
-    return metadata, new_classes
\ No newline at end of file
+    index = pd.read_csv(index_path)
+    index = index[index['label'].isin(classes)]
+    labels = tf.keras.utils.to_categorical(index['label'].map(map_class_to_id), len(new_classes))
+    reader = SegmentReader()
+
+    def load_segment(source, start, end, rate, label):
+        wav = tf.numpy_function(reader.read, [source, start, end], tf.float32)
+        wav.set_shape([None])
+        wav = tf_resample(wav, rate_in=rate, rate_out=16000)
+        return {'audio': wav, 'label': label}
+
+    splited_dataset = {}
+    for split in ['train', 'validation', 'eval']:
+        in_split = (index['split'] == split).to_numpy()
+        rows = index[in_split]
+        dataset = tf.data.Dataset.from_tensor_slices((rows['source'], rows['start'], rows['end'], rows['rate'], labels[in_split]))
+        splited_dataset[split] = dataset.map(load_segment)
+
+    return splited_dataset, new_classes
@@ -0,0 +1,224 @@
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+
+from models import YAMNET_VERSION
+from resample import RESAMPLER_VERSION
+
+
+# embeddings depend on the model bundle and on the resampler that brought the audio to 16 kHz
+EMBEDDING_VERSION = f'{YAMNET_VERSION}-{RESAMPLER_VERSION}'
+EMBEDDING_SIZE = 1024
+
+# frames per shard file - 2^18 frames of 1024 float32 is 1 GiB
+SHARD_FRAMES = 1 << 18
+INDEX_FILE = 'index.csv'
+INDEX_COLUMNS = ['key', 'version', 'filename', 'size', 'mtime', 'target', 'shard', 'offset', 'frames']
+# files handed to embed_many_fn together
+EMBED_BATCH = 64
+
+
+def file_hash(path, version=EMBEDDING_VERSION, block_size=1 << 20):
+    """ Hash of the file content and the embedding version, used as the store key. """
+    digest = hashlib.sha1(version.encode('utf-8'))
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class EmbeddingStore:
+    """ Sharded on-disk store of per-frame YAMNet embeddings.
+
+    Embeddings live in flat float32 shard files (``shard-00000.f32``, ...) that are memory-mapped on read.
+    ``index.csv`` maps each file to its key (content hash + YAMNet and resampler version), label and frame range in a shard, once
+    per version - stores of different versions can share a directory, e.g. with and without a silence filter.
+    Shards are write-once: a changed file gets a new key and new frames in a new shard, the old frames are dropped by
+    compact().
+    With embed_many_fn (filenames -> list of embeddings) new files are embedded embed_batch at a time instead of one
+    embed_fn call each.
+    """
+
+    def __init__(self, store_dir, embed_fn, version=EMBEDDING_VERSION, embed_many_fn=None, embed_batch=EMBED_BATCH):
+        self.store_dir = store_dir
+        self.embed_fn = embed_fn
+        self.embed_many_fn = embed_many_fn
+        self.embed_batch = embed_batch
+        self.version = version
+        self.index_path = os.path.join(store_dir, INDEX_FILE)
+        self._shards = {}
+
+        os.makedirs(store_dir, exist_ok=True)
+        if os.path.isfile(self.index_path):
+            # an index written before the version column never matches by filename, only by key
+            self.index = pd.read_csv(self.index_path).reindex(columns=INDEX_COLUMNS)
+        else:
+            self.index = pd.DataFrame(columns=INDEX_COLUMNS)
+
+    def shard_path(self, shard):
+        return os.path.join(self.store_dir, f'shard-{int(shard):05d}.f32')
+
+    def shard(self, shard):
+        shard = int(shard)
+        if shard not in self._shards:
+            self._shards[shard] = np.memmap(self.shard_path(shard), dtype=np.float32, mode='r').reshape(-1, EMBEDDING_SIZE)
+        return self._shards[shard]
+
+    def _next_shard(self):
+        """ A shard number past every shard in the index and on disk.
+
+        Shards of invalidated files, or written by a run that crashed before save(), are no longer in the index but
+        still on disk - a new shard never reuses their files.
+        """
+        shards = [int(name[len('shard-'):-len('.f32')]) for name in os.listdir(self.store_dir)
+                  if name.startswith('shard-') and name.endswith('.f32')]
+        if len(self.index):
+            shards.append(int(self.index['shard'].max()))
+        return max(shards) + 1 if shards else 0
+
+    def save(self):
+        tmp_path = self.index_path + '.tmp'
+        self.index.to_csv(tmp_path, index=False)
+        os.replace(tmp_path, self.index_path)
+
+    def update(self, metadata):
+        """ Embed every file of metadata that is new or changed since the last update, then save the index.
+
+        metadata needs 'filename' and 'target' columns. Unchanged files (same path, size and mtime) are not re-read.
+        Returns the index rows for metadata, in the same order.
+        """
+        versioned = self.index[self.index['version'] == self.version]
+        known = versioned.drop_duplicates('filename', keep='last').set_index('filename')
+        by_key = self.index.drop_duplicates('key', keep='last').set_index('key')
+
+        rows = []
+        pending = []
+        for filename, target in zip(metadata['filename'], metadata['target']):
+            stat = os.stat(filename)
+            if filename in known.index:
+                entry = known.loc[filename]
+                if entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns and entry['target'] == target:
+                    rows.append(dict(entry, filename=filename))
+                    continue
+
+            key = file_hash(filename, self.version)
+            if key in by_key.index:
+                # same content under a new name or label - reuse the frames
+                entry = by_key.loc[key]
+                rows.append(dict(entry, key=key, version=self.version, filename=filename, size=stat.st_size, mtime=stat.st_mtime_ns, target=target))
+                continue
+
+            rows.append({'key': key, 'version': self.version, 'filename': filename, 'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+                         'target': target})
+            pending.append(len(rows) - 1)
+
+        shard = self._next_shard()
+        shard_file = None
+        shard_frames = 0
+        batch_size = self.embed_batch if self.embed_many_fn is not None else 1
+        for first in range(0, len(pending), batch_size):
+            batch = pending[first:first + batch_size]
+            filenames = [rows[i]['filename'] for i in batch]
+            if self.embed_many_fn is not None:
+                batch_embeddings = self.embed_many_fn(filenames)
+            else:
+                batch_embeddings = [self.embed_fn(filenames[0])]
+            for i, embeddings in zip(batch, batch_embeddings):
+                embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+                if shard_file is not None and shard_frames + len(embeddings) > SHARD_FRAMES:
+                    shard_file.close()
+                    shard_file = None
+                    shard += 1
+                    shard_frames = 0
+                if shard_file is None:
+                    shard_file = open(self.shard_path(shard), 'wb')
+                shard_file.write(embeddings.tobytes())
+
+                rows[i].update({'shard': shard, 'offset': shard_frames, 'frames': len(embeddings)})
+                shard_frames += len(embeddings)
+        if shard_file is not None:
+            shard_file.close()
+            self._shards.pop(shard, None)
+
+        entries = pd.DataFrame(rows, columns=INDEX_COLUMNS)
+        stale = self.index['filename'].isin(entries['filename']) & (self.index['version'] == self.version)
+        self.index = pd.concat([self.index[~stale], entries], ignore_index=True)
+        self.save()
+        return entries
+
+    def invalidate(self, filenames):
+        """ Forget the given files so the next update() recomputes them. """
+        self.index = self.index[~self.index['filename'].isin(filenames)].reset_index(drop=True)
+        self.save()
+
+    def compact(self):
+        """ Rewrite the shards with only the frames still referenced by the index. """
+        old_shards = [name for name in os.listdir(self.store_dir) if name.startswith('shard-')]
+        # numbered past every file in old_shards, so none of the shards written here is removed below
+        live = self.index.drop_duplicates('key')
+        moved = {}
+        shard = self._next_shard()
+        shard_frames = 0
+        shard_file = open(self.shard_path(shard), 'wb')
+        for row in live.itertuples():
+            if shard_frames + row.frames > SHARD_FRAMES and shard_frames > 0:
+                shard_file.close()
+                shard += 1
+                shard_frames = 0
+                shard_file = open(self.shard_path(shard), 'wb')
+            shard_file.write(np.ascontiguousarray(self.embeddings(row._asdict())).tobytes())
+            moved[row.key] = (shard, shard_frames)
+            shard_frames += row.frames
+        shard_file.close()
+
+        self.index['shard'] = [moved[key][0] for key in self.index['key']]
+        self.index['offset'] = [moved[key][1] for key in self.index['key']]
+        self.save()
+
+        self._shards = {}
+        written = {os.path.basename(self.shard_path(number)) for number, _ in moved.values()}
+        for name in set(old_shards) - written:
+            os.remove(os.path.join(self.store_dir, name))
+
+    def embeddings(self, entry):
+        # a file with no frames, e.g. all silence in the silence filter's decision mode, may have an empty shard file
+        # that np.memmap cannot map
+        if int(entry['frames']) == 0:
+            return np.zeros((0, EMBEDDING_SIZE), dtype=np.float32)
+        return self.shard(entry['shard'])[int(entry['offset']):int(entry['offset']) + int(entry['frames'])]
+
+    def arrays(self, entries, num_classes):
+        """ All frames of entries as one contiguous (frames, 1024) array, with the repeated one-hot labels.
+
+        The whole split is read into memory at once, so a classifier head can train on it in large batches.
+        """
+        frames = entries['frames'].to_numpy(dtype=np.int64)
+        embeddings = np.empty((int(frames.sum()), EMBEDDING_SIZE), dtype=np.float32)
+        position = 0
+        for entry in entries[['shard', 'offset', 'frames']].to_dict('records'):
+            embeddings[position:position + int(entry['frames'])] = self.embeddings(entry)
+            position += int(entry['frames'])
+        labels = np.eye(num_classes, dtype=np.float32)[np.repeat(entries['target'].to_numpy(dtype=np.int64), frames)]
+        return embeddings, labels
+
+    def dataset(self, entries, num_classes):
+        """ Stream (frame embeddings, repeated one-hot label) per file, the layout data.load gives every split. """
+        import tensorflow as tf
+
+        entries = entries[['shard', 'offset', 'frames', 'target']].to_dict('records')
+        labels = np.eye(num_classes, dtype=np.float32)
+
+        def generator():
+            for entry in entries:
+                embeddings = np.asarray(self.embeddings(entry))
+                yield embeddings, np.repeat(labels[None, int(entry['target'])], len(embeddings), axis=0)
+
+        return tf.data.Dataset.from_generator(
+            generator,
+            output_signature=(
+                tf.TensorSpec(shape=(None, EMBEDDING_SIZE), dtype=tf.float32),
+                tf.TensorSpec(shape=(None, num_classes), dtype=tf.float32)
+            )
+        )
@@ -0,0 +1,124 @@
+import argparse
+import json
+import os
+import re
+
+import numpy as np
+
+import tensorflow as tf
+
+from batched_yamnet import embed_clips
+from models import import_model, model
+from timeline import EMBEDDING_SIZE
+
+
+# a variable of the top-level variables list a Keras SavedModel keeps
+MODEL_VARIABLE = re.compile(r'^variables/(\d+)/\.ATTRIBUTES/VARIABLE_VALUE$')
+
+
+def serving_head_weights(saved_model_path):
+    """ Kernels and biases of the models.model head inside a serving model exported by main.py.
+
+    They are read straight from the SavedModel's variables, so neither its YAMNet copy nor its hub handle is loaded.
+    The head is the last run of dense (kernel, bias) pairs in the model's variables that starts from the 1024-d
+    embedding and chains each layer's output into the next.
+    """
+    reader = tf.train.load_checkpoint(os.path.join(saved_model_path, 'variables', 'variables'))
+    shapes = reader.get_variable_to_shape_map()
+    matches = [(key, MODEL_VARIABLE.match(key)) for key in shapes]
+    keys = [key for _, key in sorted((int(match.group(1)), key) for key, match in matches if match)]
+
+    def dense_run(first):
+        run = []
+        inputs = EMBEDDING_SIZE
+        for kernel, bias in zip(keys[first::2], keys[first + 1::2]):
+            if len(shapes[kernel]) != 2 or shapes[kernel][0] != inputs or shapes[bias] != shapes[kernel][1:]:
+                break
+            run += [kernel, bias]
+            inputs = shapes[kernel][1]
+        return run
+
+    for first in reversed(range(len(keys))):
+        run = dense_run(first)
+        if len(run) >= 4:
+            return [reader.get_tensor(key) for key in run]
+    raise ValueError(f'no models.model head found in {saved_model_path}')
+
+def load_head(path, classes):
+    """ A models.model head from a serving model directory or a training checkpoint (save_weights_only).
+
+    A checkpoint next to a sweep params.json is rebuilt with that trial's hidden size.
+    """
+    if os.path.isfile(os.path.join(path, 'saved_model.pb')):
+        weights = serving_head_weights(path)
+        head = model(classes, hidden_units=weights[0].shape[1])
+        head.set_weights(weights)
+        return head
+
+    hidden_units = 512
+    params_path = os.path.join(os.path.dirname(path), 'params.json')
+    if os.path.isfile(params_path):
+        with open(params_path) as f:
+            hidden_units = json.load(f)['hidden_units']
+    head = model(classes, hidden_units=hidden_units)
+    head.load_weights(path).expect_partial()
+    return head
+
+
+class Ensemble:
+    """ One YAMNet with any number of classifier heads attached to its embeddings.
+
+    Each clip is embedded once, every head runs on the same frames, so adding a head costs a Dense stack and not
+    another YAMNet pass or copy of its weights.
+    """
+
+    def __init__(self, head_paths, classes, yamnet_model=None, names=None):
+        self.classes = classes
+        self.yamnet_model = yamnet_model if yamnet_model is not None else import_model('yamnet')[0]
+        self.names = names or [os.path.normpath(path) for path in head_paths]
+        self.heads = [load_head(path, classes) for path in head_paths]
+
+    @tf.function(input_signature=[tf.TensorSpec(shape=(None, EMBEDDING_SIZE), dtype=tf.float32)])
+    def head_logits(self, embeddings):
+        """ (heads, frames, classes) logits of every head over the same frames. """
+        return tf.stack([head(embeddings, training=False) for head in self.heads])
+
+    def scores(self, embeddings):
+        """ Each head's clip logits (the mean frame logits, as its serving model gives) and the ensemble output.
+
+        The ensemble output is the mean of the heads' class probabilities.
+        """
+        logits = tf.reduce_mean(self.head_logits(embeddings), axis=1).numpy()
+        probabilities = tf.nn.softmax(logits).numpy()
+        return {
+            'heads': dict(zip(self.names, logits)),
+            'ensemble': probabilities.mean(axis=0),
+        }
+
+    def __call__(self, wav):
+        _, embeddings, _ = self.yamnet_model(wav)
+        return self.scores(embeddings)
+
+    def predict_clips(self, wavs):
+        """ scores of each 16 kHz clip, with the clips' YAMNet patches batched by batched_yamnet.embed_clips. """
+        return [self.scores(embeddings) for embeddings in embed_clips(self.yamnet_model, wavs)]
+
+
+if __name__ == '__main__':
+    # python ensemble.py --head <serving model or checkpoint> [--head ...] <clip.wav> [...]
+    from data import dataset_classes, load_wav_16k_mono
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--head', dest='heads', action='append', required=True)
+    parser.add_argument('clips', nargs='+')
+    args = parser.parse_args()
+
+    _, _, classes = dataset_classes()
+    ensemble = Ensemble(args.heads, classes)
+    results = ensemble.predict_clips([load_wav_16k_mono(clip).numpy() for clip in args.clips])
+
+    print('clip,' + ','.join(ensemble.names) + ',ensemble,' + ','.join(classes))
+    for clip, result in zip(args.clips, results):
+        heads = [classes[int(np.argmax(logits))] for logits in result['heads'].values()]
+        ensemble_class = classes[int(np.argmax(result['ensemble']))]
+        print(f'{clip},' + ','.join(heads) + f',{ensemble_class},' + ','.join(f'{p:.4f}' for p in result['ensemble']))
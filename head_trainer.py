@@ -0,0 +1,57 @@
+import time
+
+import tensorflow as tf
+
+import profiling
+
+
+# frames per step - the head is two dense layers, large batches keep the step count (and Python overhead) low
+BATCH_SIZE = 4096
+MAX_EPOCHS = 300
+# epochs without a better validation accuracy before training stops
+PATIENCE = 20
+
+
+def fit_head(model, train, validation, ckpt_path, learning_rate=1e-3, batch_size=BATCH_SIZE,
+             max_epochs=MAX_EPOCHS, patience=PATIENCE, verbose=2):
+    """ Train a models.model head on in-memory (embeddings, one-hot labels) arrays, as data.load(in_memory=True) returns.
+
+    The best weights by validation accuracy are saved to ckpt_path with save_weights_only, the same checkpoint the
+    tf.data training in main.py writes, and restored into model when early stopping ends the run.
+    Returns the keras History.
+    """
+    model.compile(
+        loss=tf.keras.losses.CategoricalCrossentropy(from_logits=True),
+        optimizer=tf.keras.optimizers.Adam(learning_rate),
+        metrics=['accuracy']
+    )
+    callbacks = [
+        tf.keras.callbacks.ModelCheckpoint(
+            filepath=ckpt_path,
+            save_weights_only=True,
+            monitor='val_accuracy',
+            mode='max',
+            save_best_only=True
+        ),
+        tf.keras.callbacks.EarlyStopping(
+            monitor='val_accuracy',
+            mode='max',
+            patience=patience,
+            restore_best_weights=True
+        ),
+    ] + profiling.fit_callbacks('fit_head')
+
+    train_embeddings, train_labels = train
+    start = time.perf_counter()
+    history = model.fit(
+        train_embeddings,
+        train_labels,
+        batch_size=batch_size,
+        epochs=max_epochs,
+        shuffle=True,
+        validation_data=validation,
+        callbacks=callbacks,
+        verbose=verbose
+    )
+    print(f'{len(history.epoch)} epochs over {len(train_embeddings)} frames in {time.perf_counter() - start:.1f} s')
+    return history
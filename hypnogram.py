@@ -0,0 +1,121 @@
+import sys
+import time
+import wave
+
+import numpy as np
+
+from resample import resampler
+from segments import wav_memmap
+from vad import DECISION_CLASS, SilenceFilter
+
+
+SAMPLE_RATE = 16000
+# scoring epoch of a hypnogram
+EPOCH_SECONDS = 30
+# a trailing epoch shorter than one YAMNet patch gets no prediction
+MIN_SECONDS = 0.96
+# class order of data.load
+SLEEP_STAGES = ['wake', 'light', 'deep', 'REM']
+
+
+def pcm_to_float(frames: bytes, sample_width: int, channels: int):
+    """ First channel of little-endian PCM frames as float32 in [-1, 1), the same channel decode_wav keeps. """
+    if sample_width == 1:
+        data = (np.frombuffer(frames, dtype=np.uint8).astype(np.float32) - 128) / 128
+    elif sample_width == 2:
+        data = np.frombuffer(frames, dtype='<i2').astype(np.float32) / 32768
+    elif sample_width == 3:
+        data = np.frombuffer(frames, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        data = (data[:, 0] | (data[:, 1] << 8) | (data[:, 2] << 16)) << 8 >> 8
+        data = data.astype(np.float32) / (1 << 23)
+    elif sample_width == 4:
+        data = np.frombuffer(frames, dtype='<i4').astype(np.float32) / (1 << 31)
+    else:
+        raise ValueError(f'unsupported sample width {sample_width}')
+    return data.reshape(-1, channels)[:, 0]
+
+class PcmReader:
+    """ First channel of a PCM WAV that can not be memory-mapped (24-bit), sliced like a 1-D array of float32. """
+
+    def __init__(self, wav_path: str):
+        self.source = wave.open(wav_path, 'rb')
+        self.rate = self.source.getframerate()
+        self.sample_width = self.source.getsampwidth()
+        self.channels = self.source.getnchannels()
+
+    def __len__(self):
+        return self.source.getnframes()
+
+    def __getitem__(self, index: slice):
+        start, stop, _ = index.indices(len(self))
+        self.source.setpos(start)
+        return pcm_to_float(self.source.readframes(max(stop - start, 0)), self.sample_width, self.channels)
+
+def read_source(wav_path: str):
+    """ (first channel as a 1-D sliceable array, sample rate) of a WAV.
+
+    Memory-mapped with segments.wav_memmap (PCM and IEEE float) where it can be, read through PcmReader otherwise.
+    """
+    try:
+        samples, rate = wav_memmap(wav_path)
+    except ValueError:
+        reader = PcmReader(wav_path)
+        return reader, reader.rate
+    return samples[:, 0], rate
+
+def read_epochs(wav_path: str, epoch_seconds: int = EPOCH_SECONDS):
+    """ Yield each epoch of a WAV resampled to 16 kHz float32, one epoch in memory at a time.
+
+    Every epoch is that range of resampling the whole recording (resample.Resampler.block), as in
+    timeline.compute_timeline, so epoch boundaries see no resampler edge effects.
+    """
+    samples, rate = read_source(wav_path)
+    resampler_16k = resampler(rate, SAMPLE_RATE)
+    total_samples = resampler_16k.output_length(len(samples))
+    for first in range(0, total_samples, SAMPLE_RATE * epoch_seconds):
+        yield resampler_16k.block(samples, first, min(first + SAMPLE_RATE * epoch_seconds, total_samples))
+
+def hypnogram(saved_model, wav_path: str, output_csv_path: str, epoch_seconds: int = EPOCH_SECONDS,
+              silence_filter=None):
+    """ Score a whole-night recording epoch by epoch and write one sleep stage per epoch to output_csv_path.
+
+    Each epoch is read as its range of the 16 kHz recording (read_epochs) and scored by the serving model, which runs YAMNet's 0.96 s window
+    with a 0.48 s hop over it and averages the frame logits. Memory stays at one epoch whatever the recording length.
+    With a vad.SilenceFilter an epoch that is silence throughout is scored wake without running the model.
+    Returns the number of seconds of audio scored.
+    """
+    import tensorflow as tf
+
+    audio_seconds = 0.0
+    with open(output_csv_path, 'w') as output:
+        output.write('epoch,start,stage,' + ','.join(SLEEP_STAGES) + '\n')
+        for epoch, wav in enumerate(read_epochs(wav_path, epoch_seconds)):
+            if len(wav) < SAMPLE_RATE * MIN_SECONDS:
+                break
+            if silence_filter is not None and silence_filter.decide(wav):
+                probabilities = np.eye(len(SLEEP_STAGES), dtype=np.float32)[DECISION_CLASS]
+            else:
+                probabilities = tf.nn.softmax(saved_model(tf.constant(wav))).numpy()
+            stage = SLEEP_STAGES[int(np.argmax(probabilities))]
+            output.write(f'{epoch},{epoch * epoch_seconds},{stage},' + ','.join(f'{p:.4f}' for p in probabilities) + '\n')
+            audio_seconds += len(wav) / SAMPLE_RATE
+    return audio_seconds
+
+
+if __name__ == '__main__':
+    # usage: python hypnogram.py <serving model> <recording.wav> <hypnogram.csv> [--vad]
+    saved_model_path = sys.argv[1]
+    wav_path = sys.argv[2]
+    output_csv_path = sys.argv[3]
+    silence_filter = SilenceFilter('decision') if '--vad' in sys.argv[4:] else None
+
+    import tensorflow as tf
+
+    saved_model = tf.saved_model.load(saved_model_path)
+    start = time.time()
+    audio_seconds = hypnogram(saved_model, wav_path, output_csv_path, silence_filter=silence_filter)
+    minutes = (time.time() - start) / 60
+    print(f'{audio_seconds / 3600:.2f} h of audio in {minutes:.2f} min '
+          f'({audio_seconds / 3600 / minutes if minutes else 0.0:.2f} h of audio per minute)')
+    if silence_filter is not None:
+        print(silence_filter.report())
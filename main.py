@@ -1,33 +1,68 @@
 import functools
-import tensorflow_hub
-
-from data import load
-from models import import_model, model, ReduceMeanLayer
-
-from typing import Dict, Mapping
+import os
+import sys
+
+import models
+import profiling
+from audio_cache import AudioCache
+from batched_yamnet import batch_signature, clip_signature, embed_clips, verify_batch_signature
+from data import load, load_segments, load_wav_16k_mono, set_audio_cache
+from embedding_store import EMBEDDING_VERSION, EmbeddingStore
+from head_trainer import BATCH_SIZE, fit_head
+from models import import_model, model, resolve_bundle
+from sweep import run_sweep
+from timeline import build_timelines, load_timelines
+from vad import evaluate_filter, MODES as VAD_MODES, SilenceFilter
+
+# the training and export script always needs TensorFlow, and uses it at module level (AUTOTUNE and
+# ReduceMeanLayer) - unlike the modules it imports, it does not defer the import
 import tensorflow as tf
 
-from tflite_coverter import export_tflite
+from tflite_coverter import export_quantized, export_tflite, export_tflite_batch, QUANTIZATION_MODES
 
 
 AUTOTUNE = tf.data.experimental.AUTOTUNE
-
-
-def preprocess(inputs: Mapping[str, tf.Tensor]):
-  """Sequentially applies the transformations to the waveform."""
-  _, audio, _ = yamnet_model(inputs['audio'])
-  num_embeddings = tf.shape(audio)[0]
-  label = inputs['label']
-  return (audio, tf.repeat([label], repeats=[num_embeddings], axis=0))
-
-def extract_embedding(datasets: Dict[str, tf.data.Dataset]) -> Dict[str, tf.data.Dataset]:
-    """ Run YAMNet to extract embedding"""
-    result = {}
-    for split in ['train', 'validation', 'eval']:
-        ds = datasets[split]
-        ds = ds.map(functools.partial(preprocess), num_parallel_calls=AUTOTUNE)
-        result[split] = ds.prefetch(AUTOTUNE)
-    return result
+# training clips the int8 export calibrates on
+REPRESENTATIVE_CLIPS = 200
+# eval clips the batched signature is checked against the single-clip one on
+VERIFY_CLIPS = 32
+# fixed sample of eval clips, held in memory, the quantized exports and the silence filter are reported on
+EVAL_CLIPS = 500
+
+
+class ReduceMeanLayer(tf.keras.layers.Layer):
+    def __init__(self, axis=0, **kwargs):
+        super(ReduceMeanLayer, self).__init__(**kwargs)
+        self.axis = axis
+
+    def call(self, input):
+        return tf.math.reduce_mean(input, axis=self.axis)
+
+def embed_file(filename: str, silence_filter=None):
+  """Per-frame YAMNet embeddings of one WAV file, as stored by the embedding store - silent frames skipped with a
+  vad.SilenceFilter."""
+  with profiling.stage('yamnet'):
+    wav = load_wav_16k_mono(filename)
+    if silence_filter is not None:
+      return silence_filter.embed(yamnet_model, [wav.numpy()])[0]
+    _, embeddings, _ = yamnet_model(wav)
+    return embeddings.numpy()
+
+def embed_files(filenames, silence_filter=None):
+  """embed_file of many WAV files, their 0.96 s patches run through YAMNet in large batches."""
+  with profiling.stage('yamnet', items=len(filenames)):
+    wavs = [load_wav_16k_mono(filename).numpy() for filename in filenames]
+    if silence_filter is not None:
+      return silence_filter.embed(yamnet_model, wavs)
+    return embed_clips(yamnet_model, wavs)
+
+def baseline_head(store_path, version, data_path, classes, ckpt_path):
+  """Head trained on the unfiltered embeddings, the baseline a silence filter's report compares against."""
+  store = EmbeddingStore(store_path, embed_fn=embed_file, version=version, embed_many_fn=embed_files)
+  dataset, _ = load(path=data_path, store=store, in_memory=True)
+  head = models.model(classes)
+  fit_head(head, dataset['train'], dataset['validation'], ckpt_path)
+  return head
 
 def split_data(dataset):
     cache = dataset.cache()
@@ -40,10 +75,15 @@ def split_data(dataset):
     train = train.map(column).cache().shuffle(1000).batch(32).prefetch(tf.data.AUTOTUNE)
     validation = validation.map(column).batch(32).prefetch(tf.data.AUTOTUNE)
     test = test.map(column).batch(32).prefetch(tf.data.AUTOTUNE)
+    train = profiling.instrument(train, 'split_data/train')
+    validation = profiling.instrument(validation, 'split_data/validation')
+    test = profiling.instrument(test, 'split_data/test')
     return train, validation, test
 
 
 if __name__ == "__main__":
+    # PROFILE_REPORT=<report.json> records wall time, items and peak RSS growth per stage, see profiling.enable_from_env
+    profiling.enable_from_env()
     learning_rate = 1e-3
     metric = 'sparse_categorical_accuracy'
     num_epochs = 300
@@ -53,43 +93,104 @@ if __name__ == "__main__":
     print(f'Main Classes: {class_names}')
 
     sleep_scoring_path = 'D:/database/SMC PSG dataset/result/on-device/2/sleep scoring/'
-    dataset, classes = load(path=sleep_scoring_path)
-    print(dataset)
-    dataset = extract_embedding(dataset)
-    # dataset = dataset.map(extract_embedding)
-    print("After embedding: ")
-    print(dataset)
-
-    model = model(classes)
-    print(model.summary())
-    model.compile(
-        loss=tf.keras.losses.CategoricalCrossentropy(from_logits=True),
-        optimizer="adam",
-        metrics=['accuracy']
-    )
+    embedding_store_path = './temp/embeddings'
+    # built with `python audio_cache.py <dataset path> ./temp/audio`, misses are decoded live
+    audio_cache_path = './temp/audio'
+    if os.path.isdir(audio_cache_path):
+        set_audio_cache(AudioCache(audio_cache_path))
+    # python main.py --vad [embedding|decision]: skip YAMNet on silent frames, see vad.SilenceFilter - a report on
+    # the eval split is saved next to the serving model
+    silence_filter = None
+    if '--vad' in sys.argv[1:]:
+        vad_mode = sys.argv[sys.argv.index('--vad') + 1:]
+        silence_filter = SilenceFilter(vad_mode[0] if vad_mode and vad_mode[0] in VAD_MODES else 'embedding')
+    embedding_version = EMBEDDING_VERSION if silence_filter is None else f'{EMBEDDING_VERSION}-{silence_filter.version}'
+    # YAMNet only runs for files that are new or changed since the last run
+    store = EmbeddingStore(embedding_store_path, embed_fn=functools.partial(embed_file, silence_filter=silence_filter),
+                           version=embedding_version,
+                           embed_many_fn=functools.partial(embed_files, silence_filter=silence_filter))
     ckpt_path = './temp/checkpoint'
-    callback = tf.keras.callbacks.ModelCheckpoint(
-        filepath=ckpt_path,
-        save_weights_only=True,
-        monitor=f'val_{metric}',
-        mode='max',
-        save_best_only=True
-    )
-    history = model.fit(
-        dataset['train'],
-        validation_data=dataset['validation'],
-        epochs=num_epochs,
-        callbacks=callback
-    )
-    loss, accuracy = model.evaluate(dataset['eval'])
-    print(f'Loss: {loss}')
-    print(f'Accuracy: {accuracy}')
+    # python main.py --quantize dynamic,float16,int8: also export these quantized models, each with a report against
+    # the float model - see tflite_coverter.QUANTIZATION_MODES
+    quantize_modes = []
+    if '--quantize' in sys.argv[1:]:
+        quantize_modes = sys.argv[sys.argv.index('--quantize') + 1].split(',')
+        unknown = [mode for mode in quantize_modes if mode not in QUANTIZATION_MODES[1:]]
+        if unknown:
+            raise ValueError(f'unknown quantization modes {unknown}, expected some of {QUANTIZATION_MODES[1:]}')
+    # python main.py --segments <index.csv> <timeline dir>: train on the segments of a segments.build_segment_index
+    # index instead of clip folders, cut from per-night YAMNet timelines (computed for nights that have none yet), and
+    # take the export's calibration and eval clips from the index too
+    segments = None
+    if '--segments' in sys.argv[1:]:
+        segments = sys.argv[sys.argv.index('--segments') + 1:sys.argv.index('--segments') + 3]
+        if len(segments) != 2:
+            raise ValueError('--segments needs a segment index and a timeline directory')
+        if silence_filter is not None or '--sweep' in sys.argv[1:] or '--in-memory' in sys.argv[1:]:
+            raise ValueError('--segments trains from timelines, --vad, --sweep and --in-memory from the embedding store')
+    # python main.py --sweep [trials]: search the head hyperparameters over the stored embeddings instead, the whole
+    # grid or that many random trials - see sweep.SEARCH_SPACE
+    if '--sweep' in sys.argv[1:]:
+        trials = sys.argv[sys.argv.index('--sweep') + 1:]
+        dataset, classes = load(path=sleep_scoring_path, store=store, in_memory=True)
+        run_sweep(dataset, classes, './temp/sweep', trials=int(trials[0]) if trials else None)
+        sys.exit(0)
+    # python main.py --in-memory: train the head on all frame embeddings held in memory, with early stopping
+    in_memory = '--in-memory' in sys.argv[1:]
+    if in_memory:
+        dataset, classes = load(path=sleep_scoring_path, store=store, in_memory=True)
+        model = model(classes)
+        print(model.summary())
+        history = fit_head(model, dataset['train'], dataset['validation'], ckpt_path,
+                           learning_rate=learning_rate, max_epochs=num_epochs)
+        with profiling.stage('evaluate'):
+            loss, accuracy = model.evaluate(*dataset['eval'], batch_size=BATCH_SIZE)
+        print(f'Loss: {loss}')
+        print(f'Accuracy: {accuracy}')
+    else:
+        if segments is not None:
+            with profiling.stage('timelines'):
+                build_timelines(yamnet_model, *segments)
+            dataset, classes = load_timelines(*segments)
+        else:
+            dataset, classes = load(path=sleep_scoring_path, store=store)
+        dataset = {split: ds.prefetch(AUTOTUNE) for split, ds in dataset.items()}
+        print("After embedding: ")
+        print(dataset)
+
+        model = model(classes)
+        print(model.summary())
+        model.compile(
+            loss=tf.keras.losses.CategoricalCrossentropy(from_logits=True),
+            optimizer="adam",
+            metrics=['accuracy']
+        )
+        callback = tf.keras.callbacks.ModelCheckpoint(
+            filepath=ckpt_path,
+            save_weights_only=True,
+            monitor=f'val_{metric}',
+            mode='max',
+            save_best_only=True
+        )
+        history = model.fit(
+            dataset['train'],
+            validation_data=dataset['validation'],
+            epochs=num_epochs,
+            callbacks=[callback] + profiling.fit_callbacks()
+        )
+        with profiling.stage('evaluate'):
+            loss, accuracy = model.evaluate(dataset['eval'])
+        print(f'Loss: {loss}')
+        print(f'Accuracy: {accuracy}')
 
     saved_model_path = './results/sleep_sound_model/class 4/sample'
 
+    import tensorflow_hub
+
     input_segment = tf.keras.layers.Input(shape=(), dtype=tf.float32, name='audio')
+    # the same local YAMNet bundle the embeddings came from, no download
     embedding_extraction_layer = tensorflow_hub.KerasLayer(
-        'https://tfhub.dev/google/yamnet/1',
+        resolve_bundle('yamnet')[0],
         trainable=False,
         name='YAMNet'
     )
@@ -97,8 +198,45 @@ if __name__ == "__main__":
     serving_outputs = model(embedding_output)
     serving_outputs = ReduceMeanLayer(axis=0, name='classifier')(serving_outputs)
     serving_model = tf.keras.Model(input_segment, serving_outputs)
-    serving_model.save(saved_model_path, include_optimizer=False)
+    # serving_default scores one waveform, serving_batch a padded batch of them plus their lengths in one call - both
+    # apply the silence filter the head was trained with, so the exported model scores what it was trained on
+    signatures = {
+        'serving_default': clip_signature(embedding_extraction_layer, model, silence_filter),
+        'serving_batch': batch_signature(embedding_extraction_layer, model, silence_filter),
+    }
+    with profiling.stage('export/saved_model'):
+        serving_model.save(saved_model_path, include_optimizer=False, signatures=signatures)
 
     print(serving_model.summary())
 
-    export_tflite(saved_model_path)
+    with profiling.stage('export/tflite'):
+        export_tflite(saved_model_path)
+
+    # a fixed sample of the eval split, the same clips on every run, for the checks and reports below
+    if segments is not None:
+        audio_dataset, _ = load_segments(segments[0])
+    else:
+        audio_dataset, _ = load(path=sleep_scoring_path, rescan=False)
+    eval_sample = audio_dataset['eval'].shuffle(10000, seed=0, reshuffle_each_iteration=False).take(EVAL_CLIPS)
+    eval_data = [(example['audio'].numpy(), int(tf.argmax(example['label']))) for example in eval_sample]
+    verify_wavs = [wav for wav, _ in eval_data[:VERIFY_CLIPS]]
+    with profiling.stage('export/verify_batch'):
+        print(f'serving_batch within {verify_batch_signature(saved_model_path, verify_wavs):.2e} of serving_default')
+        export_tflite_batch(saved_model_path, verify_wavs)
+
+    # quantized exports, calibrated on training clips and compared with the float model on the eval sample
+    if quantize_modes:
+        representative_wavs = [example['audio'].numpy() for example in audio_dataset['train'].shuffle(1000, seed=0).take(REPRESENTATIVE_CLIPS)]
+        with profiling.stage('export/quantized', items=len(quantize_modes)):
+            export_quantized(saved_model_path, quantize_modes, representative_wavs, eval_data)
+
+    if silence_filter is not None:
+        # the unfiltered embeddings share the store directory under their own version
+        with profiling.stage('vad/baseline_head'):
+            unfiltered_head = baseline_head(embedding_store_path, EMBEDDING_VERSION, sleep_scoring_path, classes,
+                                          ckpt_path + '-baseline')
+        with profiling.stage('vad/report', items=len(eval_data)):
+            evaluate_filter(yamnet_model, unfiltered_head, model, eval_data, silence_filter,
+                            os.path.join(saved_model_path, 'vad_report.json'))
+
+    profiling.save_report()
@@ -0,0 +1,84 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+
+MANIFEST_FILE = 'manifest.csv'
+MANIFEST_COLUMNS = ['filename', 'class', 'target', 'split', 'size', 'mtime']
+# integer columns, also when concatenated with an empty manifest - an mtime in ns does not survive a float64 round trip
+MANIFEST_INTEGERS = {'target': np.int64, 'size': np.int64, 'mtime': np.int64}
+
+
+def assign_split(count: int, train_ratio: float):
+    """ Split labels for count files of one class: first train_ratio train, the rest halved into validation/eval. """
+    num_train = int(count * train_ratio)
+    num_validation = (count - num_train) // 2
+    position = np.arange(count)
+    return np.select(
+        [position < num_train, position < num_train + num_validation],
+        ['train', 'validation'],
+        'eval'
+    )
+
+def assign_added_split(known_split: pd.Series, count: int, train_ratio: float):
+    """ Split labels for count new files of a class, topping up the splits that fell below their ratio. """
+    names = ['train', 'validation', 'eval']
+    target = pd.Series(assign_split(len(known_split) + count, train_ratio)).value_counts().reindex(names, fill_value=0)
+    have = known_split.value_counts().reindex(names, fill_value=0)
+    deficit = (target - have).clip(lower=0)
+    return np.repeat(names, deficit.to_numpy())[:count]
+
+def scan_class(path: str, class_name: str):
+    """ Sorted file names and their size/mtime under path/class_name. """
+    entries = sorted((entry for entry in os.scandir(path + class_name) if entry.is_file()), key=lambda entry: entry.name)
+    stats = [entry.stat() for entry in entries]
+    return pd.DataFrame({
+        'filename': [path + class_name + '/' + entry.name for entry in entries],
+        'size': [stat.st_size for stat in stats],
+        'mtime': [stat.st_mtime_ns for stat in stats],
+    })
+
+def load_manifest(path: str, classes, map_class_to_id, train_ratio: float, manifest_path: str = None, rescan: bool = True):
+    """ Read the dataset manifest of path, picking up added and removed files first if rescan is set.
+
+    Files already in the manifest keep their split, with size and mtime refreshed from the scan, new files of a class
+    fill the splits back up to their ratio.
+    """
+    if manifest_path is None:
+        manifest_path = os.path.join(path, MANIFEST_FILE)
+
+    if os.path.isfile(manifest_path):
+        manifest = pd.read_csv(manifest_path)
+    else:
+        manifest = pd.DataFrame(columns=MANIFEST_COLUMNS)
+        rescan = True
+    if not rescan:
+        return manifest
+
+    updated = []
+    changed = False
+    for class_name in classes:
+        known = manifest[manifest['class'] == class_name]
+        on_disk = scan_class(path, class_name)
+
+        kept = known[known['filename'].isin(on_disk['filename'])].copy()
+        added = on_disk[~on_disk['filename'].isin(known['filename'])].copy()
+        # a file rewritten in place keeps its split but gets its new stat
+        stat = on_disk.set_index('filename').loc[kept['filename']]
+        rewritten = (kept['size'].to_numpy() != stat['size'].to_numpy()) | (kept['mtime'].to_numpy() != stat['mtime'].to_numpy())
+        kept['size'] = stat['size'].to_numpy()
+        kept['mtime'] = stat['mtime'].to_numpy()
+        changed = changed or len(kept) != len(known) or len(added) > 0 or bool(rewritten.any())
+
+        added['class'] = class_name
+        added['target'] = map_class_to_id[class_name]
+        added['split'] = assign_added_split(kept['split'], len(added), train_ratio)
+        updated += [kept.astype(MANIFEST_INTEGERS), added[MANIFEST_COLUMNS].astype(MANIFEST_INTEGERS)]
+
+    manifest = pd.concat(updated, ignore_index=True)
+    if changed:
+        tmp_path = manifest_path + '.tmp'
+        manifest.to_csv(tmp_path, index=False)
+        os.replace(tmp_path, manifest_path)
+    return manifest
@@ -1,27 +1,83 @@
+import hashlib
+import json
+import os
+import shutil
+import sys
+
 import pandas as pd
 
-import tensorflow as tf
-import tensorflow_hub as hub
 
+# local model bundles, <root>/<name>/<version>/ - a SavedModel plus bundle.json pinning its source and class map
+MODEL_ROOT = os.environ.get('MODEL_ROOT', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bundles'))
+BUNDLE_FILE = 'bundle.json'
+YAMNET_HANDLE = 'https://tfhub.dev/google/yamnet/1'
+YAMNET_VERSION = '1'
+YAMNET_CLASS_MAP = os.path.join('assets', 'yamnet_class_map.csv')
+
+
+def bundle_path(name='yamnet', version=YAMNET_VERSION, root=MODEL_ROOT):
+    return os.path.join(root, name, version)
+
+def file_sha1(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def resolve_bundle(name='yamnet', version=YAMNET_VERSION, root=MODEL_ROOT):
+    """ Path and bundle.json of a local model bundle, checking its class map against the pinned hash.
+
+    Never touches the network: a missing bundle is an error telling how to fetch it once.
+    """
+    path = bundle_path(name, version, root)
+    if not os.path.isfile(os.path.join(path, BUNDLE_FILE)):
+        raise FileNotFoundError(f'no {name} {version} bundle in {path}, fetch it once with `python models.py fetch`')
+    with open(os.path.join(path, BUNDLE_FILE)) as f:
+        bundle = json.load(f)
+    class_map_path = os.path.join(path, bundle['class_map'])
+    if file_sha1(class_map_path) != bundle['class_map_sha1']:
+        raise ValueError(f'{class_map_path} does not match the class map pinned in {BUNDLE_FILE}')
+    return path, bundle
+
+def fetch_bundle(handle=YAMNET_HANDLE, name='yamnet', version=YAMNET_VERSION, root=MODEL_ROOT):
+    """ Download a TF Hub model once and save it as a local bundle, pinning the hash of its class map. """
+    import tensorflow_hub as hub
+
+    path = bundle_path(name, version, root)
+    shutil.copytree(hub.resolve(handle), path, dirs_exist_ok=True)
+    bundle = {
+        'name': name,
+        'version': version,
+        'source': handle,
+        'class_map': YAMNET_CLASS_MAP,
+        'class_map_sha1': file_sha1(os.path.join(path, YAMNET_CLASS_MAP)),
+    }
+    with open(os.path.join(path, BUNDLE_FILE), 'w') as f:
+        json.dump(bundle, f, indent=2)
+    return path
 
 def import_model(vggish):
+    import tensorflow as tf
+
     if vggish == 'yamnet':
-        yamnet_model = hub.load('https://tfhub.dev/google/yamnet/1')
-        class_map_path = yamnet_model.class_map_path().numpy().decode('utf-8')
-        class_names = list(pd.read_csv(class_map_path)['display_name'])
+        path, bundle = resolve_bundle('yamnet')
+        yamnet_model = tf.saved_model.load(path)
+        class_names = list(pd.read_csv(os.path.join(path, bundle['class_map']))['display_name'])
         return yamnet_model, class_names
 
-def model(classes):
-    return tf.keras.Sequential([
+def model(classes, hidden_units=512, dropout=0.0):
+    import tensorflow as tf
+
+    layers = [
         tf.keras.layers.Input(shape=1024, dtype=tf.float32, name='input_embedding'),
-        tf.keras.layers.Dense(512, activation='relu'),
-        tf.keras.layers.Dense(len(classes))
-    ], name='model')
+        tf.keras.layers.Dense(hidden_units, activation='relu'),
+    ]
+    if dropout:
+        # no weights, so the checkpoint layout only depends on hidden_units
+        layers.append(tf.keras.layers.Dropout(dropout))
+    layers.append(tf.keras.layers.Dense(len(classes)))
+    return tf.keras.Sequential(layers, name='model')
 
-class ReduceMeanLayer(tf.keras.layers.Layer):
-    def __init__(self, axis=0, **kwargs):
-        super(ReduceMeanLayer, self).__init__(**kwargs)
-        self.axis = axis
 
-    def call(self, input):
-        return tf.math.reduce_mean(input, axis=self.axis)
\ No newline at end of file
+if __name__ == '__main__':
+    # python models.py fetch [model root] - needs network once, every later run loads the bundle from disk
+    if len(sys.argv) > 1 and sys.argv[1] == 'fetch':
+        print(f'YAMNet bundle saved to {fetch_bundle(root=sys.argv[2] if len(sys.argv) > 2 else MODEL_ROOT)}')
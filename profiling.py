@@ -0,0 +1,213 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+
+# opt-in: PROFILE_REPORT=<report.json> [PROFILE_TRACE=<log dir> PROFILE_STEPS=<first>,<last>]
+REPORT_ENV = 'PROFILE_REPORT'
+TRACE_ENV = 'PROFILE_TRACE'
+STEPS_ENV = 'PROFILE_STEPS'
+
+
+class StageTimer:
+    """ Thread-safe wall time and item counts per named pipeline stage. """
+
+    def __init__(self):
+        self.stages = {}
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+
+    def record(self, stage, seconds, items=1, peak_rss_growth=None):
+        """ Add one call of stage, keeping the largest peak_rss_growth (MiB) the process peak RSS rose by in a call. """
+        # not the peak itself - ru_maxrss only ever grows, at the end of a call it is the peak of every earlier stage too
+        with self._lock:
+            total = self.stages.setdefault(stage, {'seconds': 0.0, 'items': 0, 'calls': 0})
+            total['seconds'] += seconds
+            total['items'] += items
+            total['calls'] += 1
+            if peak_rss_growth is not None:
+                total['peak_rss_growth_mb'] = max(total.get('peak_rss_growth_mb', 0.0), peak_rss_growth)
+
+    @contextmanager
+    def stage(self, stage, items=1):
+        """ Time the block as one call of stage, with how far it raised the process peak RSS. """
+        start = time.perf_counter()
+        start_rss = peak_rss_mb()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start, items, peak_rss_mb() - start_rss)
+
+    def elapsed(self):
+        return time.perf_counter() - self._start
+
+    def summary(self, items=None):
+        """ Text report: per-stage total and mean latency, plus overall throughput if items is given. """
+        elapsed = self.elapsed()
+        lines = []
+        if items is not None:
+            lines.append(f'{items} files in {elapsed:.2f}s ({items / elapsed if elapsed else 0.0:.2f} files/s)')
+        for stage, total in self.stages.items():
+            mean = total['seconds'] / total['items'] * 1000 if total['items'] else 0.0
+            lines.append(f"  {stage}: {total['seconds']:.2f}s total, {mean:.2f} ms/item over {total['items']} items")
+        return '\n'.join(lines)
+
+    def report(self):
+        """ The stages as a JSON-serialisable dict, with mean ms per item. """
+        with self._lock:
+            stages = {stage: dict(total) for stage, total in self.stages.items()}
+        for total in stages.values():
+            total['ms_per_item'] = total['seconds'] / total['items'] * 1000 if total['items'] else 0.0
+        return {'elapsed_s': self.elapsed(), 'peak_rss_mb': peak_rss_mb(), 'stages': stages}
+
+
+def peak_rss_mb():
+    """ Peak resident set size of this process so far, in MiB. """
+    try:
+        import resource
+        # ru_maxrss is KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    except ImportError:
+        import psutil
+        return psutil.Process().memory_info().peak_wset / (1024 * 1024)
+
+
+class Profile:
+    """ Opt-in instrumentation of one run: a StageTimer saved as a JSON report, plus an optional tf.profiler trace.
+
+    Steps are counted by step(); the trace covers steps [first, last) of trace_steps and is written to trace_dir.
+    """
+
+    def __init__(self, report_path, trace_dir=None, trace_steps=None):
+        self.report_path = report_path
+        self.trace_dir = trace_dir
+        self.trace_steps = trace_steps
+        self.timer = StageTimer()
+        self.steps = 0
+        self._tracing = False
+        self._lock = threading.Lock()
+
+    def step(self):
+        with self._lock:
+            if self.trace_dir is not None:
+                import tensorflow as tf
+
+                first, last = self.trace_steps
+                if self.steps == first and not self._tracing:
+                    tf.profiler.experimental.start(self.trace_dir)
+                    self._tracing = True
+                elif self.steps == last and self._tracing:
+                    tf.profiler.experimental.stop()
+                    self._tracing = False
+            self.steps += 1
+
+    def save(self):
+        if self._tracing:
+            import tensorflow as tf
+
+            tf.profiler.experimental.stop()
+            self._tracing = False
+        report = self.timer.report()
+        report['steps'] = self.steps
+        if self.trace_dir is not None:
+            report['trace'] = {'dir': self.trace_dir, 'steps': list(self.trace_steps)}
+        with open(self.report_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Profile report saved to {self.report_path}')
+
+
+# the Profile of this process, None unless enabled
+_profile = None
+
+
+def enable(report_path, trace_dir=None, trace_steps=(10, 20)):
+    global _profile
+    _profile = Profile(report_path, trace_dir, trace_steps)
+    return _profile
+
+def enable_from_env():
+    """ Enable profiling if PROFILE_REPORT is set, tracing PROFILE_STEPS (default 10,20) if PROFILE_TRACE is set. """
+    if os.environ.get(REPORT_ENV):
+        steps = tuple(int(step) for step in os.environ.get(STEPS_ENV, '10,20').split(','))
+        enable(os.environ[REPORT_ENV], os.environ.get(TRACE_ENV), steps)
+    return _profile
+
+def profile():
+    return _profile
+
+def stage(name, items=1):
+    """ StageTimer.stage of the enabled profile, a no-op context otherwise. """
+    if _profile is None:
+        return nullcontext()
+    return _profile.timer.stage(name, items)
+
+def step():
+    if _profile is not None:
+        _profile.step()
+
+def save_report():
+    if _profile is not None:
+        _profile.save()
+
+def instrument(dataset, name):
+    """ Count the elements of a tf.data pipeline as they leave it, timing the gap since the previous one.
+
+    The gap is the wall time the consumer waits on everything upstream of this point, so instrumenting after each
+    transformation shows which one the time goes to. The first element of every iterator (every epoch) starts the
+    clock again, so the time between epochs is not counted as a gap. Returns dataset unchanged when profiling is off.
+    """
+    if _profile is None:
+        return dataset
+    import tensorflow as tf
+
+    timer = _profile.timer
+    last = [None]
+
+    def tick(index):
+        now = time.perf_counter()
+        if index > 0 and last[0] is not None:
+            timer.record(name, now - last[0])
+        last[0] = now
+        return True
+
+    # enumerate counts from 0 again in every new iterator
+    def probe(index, element):
+        with tf.control_dependencies([tf.numpy_function(tick, [index], tf.bool)]):
+            return tf.nest.map_structure(tf.identity, element)
+
+    return dataset.enumerate().map(probe)
+
+def fit_callbacks(name='fit'):
+    """ Keras callbacks timing training and validation steps and epochs, and counting train steps for the trace. """
+    if _profile is None:
+        return []
+    import tensorflow as tf
+
+    timer = _profile.timer
+
+    class ProfileCallback(tf.keras.callbacks.Callback):
+
+        def on_train_batch_begin(self, batch, logs=None):
+            step()
+            self._batch_start = time.perf_counter()
+
+        def on_train_batch_end(self, batch, logs=None):
+            timer.record(f'{name}/train_step', time.perf_counter() - self._batch_start)
+
+        def on_test_batch_begin(self, batch, logs=None):
+            self._test_start = time.perf_counter()
+
+        def on_test_batch_end(self, batch, logs=None):
+            timer.record(f'{name}/validation_step', time.perf_counter() - self._test_start)
+
+        def on_epoch_begin(self, epoch, logs=None):
+            self._epoch_start = time.perf_counter()
+            self._epoch_rss = peak_rss_mb()
+
+        def on_epoch_end(self, epoch, logs=None):
+            timer.record(f'{name}/epoch', time.perf_counter() - self._epoch_start,
+                         peak_rss_growth=peak_rss_mb() - self._epoch_rss)
+
+    return [ProfileCallback()]
@@ -0,0 +1,138 @@
+import functools
+import math
+import sys
+
+import numpy as np
+
+from segments import to_float
+
+
+SAMPLE_RATE = 16000
+# filter half length in input or output periods, whichever is longer, and its Kaiser window - the design of
+# scipy.signal.resample_poly
+HALF_PERIODS = 10
+KAISER_BETA = 5.0
+# tag of this filter design, in the keys of everything cached from resampled audio - a new design is a cache miss
+RESAMPLER_VERSION = f'polyphase-kaiser{HALF_PERIODS}-b{KAISER_BETA:g}'
+# output samples computed per block, memory stays at about BLOCK_OUTPUTS * taps per phase floats
+BLOCK_OUTPUTS = 1 << 16
+# tones (Hz) of the fidelity check, in the passband of 16 kHz output, and one above its Nyquist frequency
+PASSBAND_TONES = [100.0, 440.0, 1000.0, 3150.0, 6300.0]
+STOPBAND_TONE = 11000.0
+
+
+class Resampler:
+    """ Polyphase FIR resampling from rate_in to rate_out, the filters designed once.
+
+    The windowed-sinc low-pass is split into one short filter per output phase, and every output sample is one dot
+    product of its phase's filter with the input samples under it. The outputs are computed block by block, each
+    block reading only the input it needs, so a memory-mapped recording never has to be loaded whole and any
+    [first, last) range of outputs is that range of the whole signal's resampling, to float32 rounding.
+    """
+
+    def __init__(self, rate_in, rate_out=SAMPLE_RATE):
+        self.rate_in = rate_in
+        self.rate_out = rate_out
+        divisor = math.gcd(rate_in, rate_out)
+        self.up = rate_out // divisor
+        self.down = rate_in // divisor
+
+        half_length = HALF_PERIODS * max(self.up, self.down)
+        cutoff = 1 / max(self.up, self.down)
+        h = cutoff * np.sinc(cutoff * np.arange(-half_length, half_length + 1)) * np.kaiser(2 * half_length + 1, KAISER_BETA)
+        h *= self.up / h.sum()
+        self.taps = -(-len(h) // self.up)
+        h = np.pad(h, (0, self.taps * self.up - len(h)))
+
+        # output q * up + r is the phase (r * down + half_length) % up filter, time reversed, over the input
+        # window ending at q * down + offsets[r]
+        delays = np.arange(self.up) * self.down + half_length
+        self.filters = h.reshape(self.taps, self.up).T[delays % self.up, ::-1].astype(np.float32)
+        self.offsets = delays // self.up
+
+    def output_length(self, input_length):
+        return -(-input_length * self.up // self.down)
+
+    def block(self, samples, first, last):
+        """ Outputs [first, last) of resampling all of samples, a 1-D array of any decode_wav-scaled dtype. """
+        if self.up == self.down:
+            return to_float(np.asarray(samples[first:last]))
+        if last <= first:
+            return np.zeros(0, dtype=np.float32)
+
+        q = np.arange(first // self.up, -(-last // self.up))
+        start = q[0] * self.down + self.offsets.min() - self.taps + 1
+        end = q[-1] * self.down + self.offsets.max() + 1
+        segment = np.zeros(end - start, dtype=np.float32)
+        lo, hi = max(start, 0), min(end, len(samples))
+        if lo < hi:
+            segment[lo - start:hi - start] = to_float(np.asarray(samples[lo:hi]))
+
+        # one strided view of the input windows per phase, every phase's outputs a single matrix-vector product
+        windows = np.lib.stride_tricks.sliding_window_view(segment, self.taps)
+        outputs = np.empty((len(q), self.up), dtype=np.float32)
+        base = q[0] * self.down - self.taps + 1 - start
+        for phase, (offset, phase_filter) in enumerate(zip(self.offsets, self.filters)):
+            outputs[:, phase] = np.einsum('qt,t->q', windows[base + offset::self.down][:len(q)], phase_filter)
+        skip = first - q[0] * self.up
+        return outputs.reshape(-1)[skip:skip + last - first]
+
+    def __call__(self, samples, block_outputs=BLOCK_OUTPUTS):
+        """ Resample all of samples, block_outputs output samples at a time. """
+        total = self.output_length(len(samples))
+        step = max(block_outputs // self.up, 1) * self.up
+        outputs = np.empty(total, dtype=np.float32)
+        for first in range(0, total, step):
+            last = min(first + step, total)
+            outputs[first:last] = self.block(samples, first, last)
+        return outputs
+
+@functools.lru_cache(maxsize=None)
+def resampler(rate_in, rate_out=SAMPLE_RATE):
+    """ The Resampler of a rate pair, designed on first use and shared afterwards. """
+    return Resampler(int(rate_in), int(rate_out))
+
+def resample(samples, rate_in, rate_out=SAMPLE_RATE):
+    """ samples (1-D, any decode_wav-scaled dtype) resampled from rate_in to rate_out as float32. """
+    return resampler(rate_in, rate_out)(samples)
+
+def tf_resample(wav, rate_in, rate_out=SAMPLE_RATE):
+    """ resample for a 1-D float tensor, usable in tf.function and tf.data maps, rate_in may be a tensor. """
+    import tensorflow as tf
+
+    wav = tf.numpy_function(lambda samples, rate: resample(samples, int(rate), rate_out),
+                            [wav, tf.cast(rate_in, tf.int64)], tf.float32, stateful=False)
+    wav.set_shape([None])
+    return wav
+
+
+def tones(frequencies, seconds, rate):
+    t = np.arange(int(seconds * rate)) / rate
+    return sum(np.sin(2 * np.pi * frequency * t) for frequency in frequencies) / len(frequencies)
+
+def fidelity(rate_in, rate_out=SAMPLE_RATE, seconds=2.0, resample_fn=None):
+    """ Passband SNR and stopband rejection (dB) of a resampler, against tones computed directly at rate_out.
+
+    resample_fn(samples, rate_in, rate_out) defaults to resample. A filter's first and last HALF_PERIODS * 5 ms are
+    left out, where the signal is cut off rather than resampled.
+    """
+    resample_fn = resample_fn or resample
+    frequencies = [frequency for frequency in PASSBAND_TONES if frequency < 0.4 * min(rate_in, rate_out)]
+    edge = int(0.005 * HALF_PERIODS * rate_out)
+    expected = tones(frequencies, seconds, rate_out)[edge:-edge]
+    passband = np.asarray(resample_fn(tones(frequencies, seconds, rate_in).astype(np.float32), rate_in, rate_out))
+    passband = passband[edge:edge + len(expected)]
+    stopband = np.asarray(resample_fn(tones([STOPBAND_TONE], seconds, rate_in).astype(np.float32), rate_in, rate_out))
+    stopband = stopband[edge:edge + len(expected)]
+    return {
+        'rate_in': rate_in,
+        'rate_out': rate_out,
+        'snr_db': float(10 * np.log10(np.sum(expected ** 2) / np.sum((passband - expected) ** 2))),
+        'stopband_db': float(10 * np.log10(np.mean(stopband ** 2) / 0.5)) if rate_in / 2 > STOPBAND_TONE else None,
+    }
+
+
+if __name__ == '__main__':
+    # usage: python resample.py [rate_in ...] - fidelity of the resampler from each rate to 16 kHz
+    for rate_in in [int(rate) for rate in sys.argv[1:]] or [22050, 44100, 48000]:
+        print(fidelity(rate_in))
@@ -0,0 +1,121 @@
+import os
+import struct
+import sys
+
+import numpy as np
+import pandas as pd
+
+from manifest import assign_split
+
+
+SEGMENT_INDEX_COLUMNS = ['source', 'start', 'end', 'rate', 'label', 'split']
+
+# WAVE_FORMAT_PCM, WAVE_FORMAT_IEEE_FLOAT, WAVE_FORMAT_EXTENSIBLE
+PCM = 1
+IEEE_FLOAT = 3
+EXTENSIBLE = 0xFFFE
+
+
+def wav_layout(path: str):
+    """ (format tag, channels, sample rate, bits per sample, data offset, data size) from the RIFF header of path. """
+    with open(path, 'rb') as f:
+        riff, _, wave = struct.unpack('<4sI4s', f.read(12))
+        if riff != b'RIFF' or wave != b'WAVE':
+            raise ValueError(f'{path} is not a RIFF WAVE file')
+        fmt = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError(f'{path} has no data chunk')
+            chunk_id, chunk_size = struct.unpack('<4sI', header)
+            if chunk_id == b'fmt ':
+                chunk = f.read(chunk_size)
+                format_tag, channels, rate, _, _, bits = struct.unpack('<HHIIHH', chunk[:16])
+                if format_tag == EXTENSIBLE:
+                    # the real format tag leads the sub-format GUID
+                    format_tag = struct.unpack('<H', chunk[24:26])[0]
+                fmt = (format_tag, channels, rate, bits)
+            elif chunk_id == b'data':
+                if fmt is None:
+                    raise ValueError(f'{path} has a data chunk before its fmt chunk')
+                return fmt + (f.tell(), chunk_size)
+            else:
+                f.seek(chunk_size, os.SEEK_CUR)
+            # chunks are word aligned
+            if chunk_size % 2:
+                f.seek(1, os.SEEK_CUR)
+
+def wav_memmap(path: str):
+    """ Memory-map the samples of a PCM or float WAV as a (frames, channels) array, without reading them. """
+    format_tag, channels, rate, bits, offset, size = wav_layout(path)
+    dtypes = {(PCM, 8): np.uint8, (PCM, 16): np.int16, (PCM, 32): np.int32, (IEEE_FLOAT, 32): np.float32, (IEEE_FLOAT, 64): np.float64}
+    if (format_tag, bits) not in dtypes:
+        raise ValueError(f'{path}: {bits}-bit samples with format tag {format_tag} can not be memory-mapped')
+    dtype = np.dtype(dtypes[(format_tag, bits)]).newbyteorder('<')
+    size = min(size, os.path.getsize(path) - offset)
+    frames = size // (dtype.itemsize * channels)
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(frames, channels)), rate
+
+def to_float(samples):
+    """ Samples of any memory-mapped WAV dtype as float32 in [-1, 1), the scaling decode_wav uses. """
+    if samples.dtype == np.uint8:
+        return (samples.astype(np.float32) - 128) / 128
+    if samples.dtype.kind == 'i':
+        return samples.astype(np.float32) / np.float32(1 << (8 * samples.dtype.itemsize - 1))
+    return samples.astype(np.float32)
+
+
+class SegmentReader:
+    """ Read segments as slices of memory-mapped source recordings, keeping one mapping per source open. """
+
+    def __init__(self):
+        self._sources = {}
+
+    def source(self, path):
+        if path not in self._sources:
+            self._sources[path] = wav_memmap(path)
+        return self._sources[path]
+
+    def read(self, path, start, end):
+        """ First channel of samples [start, end) of path as float32, the channel decode_wav keeps. """
+        if isinstance(path, bytes):
+            path = path.decode('utf-8')
+        samples, _ = self.source(path)
+        return to_float(samples[int(start):int(end), 0])
+
+
+def build_segment_index(pairs, index_path: str, classes, train_ratio: float):
+    """ Index the annotated segments of (source audio, trimmer csv) pairs instead of writing one WAV per event.
+
+    Each row is a sample range of a source recording with its event label, the same slices trimmer.trim_file cuts.
+    Segments of the given classes are split per class in recording order, like data.load splits clip folders.
+    """
+    from certificate.trimmer import plan_segments
+
+    rows = []
+    for source_audio_path, source_csv_path in pairs:
+        samples, rate = wav_memmap(source_audio_path)
+        for start_timestamp, finish_timestamp, event, _ in plan_segments(source_audio_path, source_csv_path, create_dirs=False):
+            start = int(round(start_timestamp * rate))
+            end = min(int(round(finish_timestamp * rate)), len(samples))
+            if start < end and event in classes:
+                rows.append({'source': source_audio_path, 'start': start, 'end': end, 'rate': rate, 'label': event})
+
+    index = pd.DataFrame(rows, columns=SEGMENT_INDEX_COLUMNS)
+    index['split'] = ''
+    for class_name in classes:
+        in_class = (index['label'] == class_name).to_numpy()
+        index.loc[in_class, 'split'] = assign_split(int(in_class.sum()), train_ratio)
+
+    index.to_csv(index_path, index=False)
+    return index
+
+
+if __name__ == '__main__':
+    # usage: python segments.py <batch.tsv> <segments.csv>
+    from certificate.trimmer import read_batch
+    from data import TRAIN_RATIO, dataset_classes
+
+    classes, _, _ = dataset_classes('sleep_scoring')
+    index = build_segment_index(read_batch(sys.argv[1]), sys.argv[2], classes, TRAIN_RATIO)
+    print(f'{len(index)} segments from {index["source"].nunique()} recordings')
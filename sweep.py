@@ -0,0 +1,115 @@
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+
+
+# the hyperparameters models.model and head_trainer.fit_head take, searched over by grid or random sampling
+SEARCH_SPACE = {
+    'hidden_units': [256, 512, 1024],
+    'learning_rate': [1e-4, 3e-4, 1e-3, 3e-3],
+    'dropout': [0.0, 0.2, 0.5],
+    'epochs': [50, 100, 300],
+}
+# TensorFlow threads per trial - trials run side by side, cpu_count / THREADS_PER_TRIAL at a time
+THREADS_PER_TRIAL = 2
+SPLITS = ['train', 'validation', 'eval']
+RESULTS_FILE = 'results.csv'
+BEST_DIR = 'best'
+
+
+def grid(space=SEARCH_SPACE):
+    """ Every combination of the search space, in order. """
+    names = list(space)
+    return [dict(zip(names, values)) for values in itertools.product(*(space[name] for name in names))]
+
+def sample(space=SEARCH_SPACE, trials=20, seed=0):
+    """ trials distinct combinations of the search space drawn at random, or the whole grid if it is smaller. """
+    combinations = grid(space)
+    if trials >= len(combinations):
+        return combinations
+    return random.Random(seed).sample(combinations, trials)
+
+def save_splits(splits, data_dir):
+    """ Write the (embeddings, labels) arrays of data.load(in_memory=True) once, for every trial to memory-map. """
+    os.makedirs(data_dir, exist_ok=True)
+    for split in SPLITS:
+        embeddings, labels = splits[split]
+        np.save(os.path.join(data_dir, f'{split}_embeddings.npy'), embeddings)
+        np.save(os.path.join(data_dir, f'{split}_labels.npy'), labels)
+
+def load_splits(data_dir):
+    return {split: (np.load(os.path.join(data_dir, f'{split}_embeddings.npy'), mmap_mode='r'),
+                    np.load(os.path.join(data_dir, f'{split}_labels.npy'), mmap_mode='r')) for split in SPLITS}
+
+
+def _init_worker(threads):
+    # trials share the cores - keep each TensorFlow runtime to its own slice of them
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+def _run_trial(args):
+    trial, params, classes, data_dir, trial_dir = args
+    from head_trainer import BATCH_SIZE, fit_head
+    from models import model
+
+    splits = load_splits(data_dir)
+    train, validation = [tuple(np.asarray(array) for array in splits[split]) for split in SPLITS[:2]]
+    eval_embeddings, eval_labels = (np.asarray(array) for array in splits['eval'])
+
+    head = model(classes, hidden_units=params['hidden_units'], dropout=params['dropout'])
+    start = time.perf_counter()
+    history = fit_head(head, train, validation, os.path.join(trial_dir, 'checkpoint'),
+                       learning_rate=params['learning_rate'], max_epochs=params['epochs'], verbose=0)
+    seconds = time.perf_counter() - start
+    _, eval_accuracy = head.evaluate(eval_embeddings, eval_labels, batch_size=BATCH_SIZE, verbose=0)
+    return dict(params, trial=trial, val_accuracy=max(history.history['val_accuracy']), eval_accuracy=eval_accuracy,
+                epochs_run=len(history.epoch), seconds=seconds)
+
+def run_sweep(splits, classes, output_dir, trials=None, threads_per_trial=THREADS_PER_TRIAL, space=SEARCH_SPACE):
+    """ Train a head per trial of the search space in a process pool and rank them by validation accuracy.
+
+    trials=None runs the whole grid, a number runs that many random combinations. All trials train on the same
+    embeddings, saved once to output_dir from splits (data.load(in_memory=True)), so YAMNet never runs again.
+    Writes output_dir/results.csv, and the best trial's checkpoint and hyperparameters to output_dir/best.
+    Returns the ranked results.
+    """
+    trial_params = grid(space) if trials is None else sample(space, trials)
+    data_dir = os.path.join(output_dir, 'data')
+    save_splits(splits, data_dir)
+
+    processes = max(1, min(len(trial_params), os.cpu_count() // threads_per_trial))
+    jobs = [(trial, params, classes, data_dir, os.path.join(output_dir, f'trial-{trial:03d}'))
+            for trial, params in enumerate(trial_params)]
+    print(f'{len(jobs)} trials, {processes} at a time with {threads_per_trial} threads each')
+
+    rows = []
+    # spawn - the caller may already have a TensorFlow runtime, which does not survive a fork
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(processes, initializer=_init_worker, initargs=(threads_per_trial,)) as pool:
+        for row in pool.imap_unordered(_run_trial, jobs):
+            print(f"trial {row['trial']}: val {row['val_accuracy']:.4f}, eval {row['eval_accuracy']:.4f} "
+                  f"after {row['epochs_run']} epochs in {row['seconds']:.1f}s")
+            rows.append(row)
+
+    # ties go to the faster trial, eval accuracy is reported but never chosen on
+    results = pd.DataFrame(rows).sort_values(['val_accuracy', 'seconds'], ascending=[False, True])
+    results.insert(0, 'rank', range(1, len(results) + 1))
+    results.to_csv(os.path.join(output_dir, RESULTS_FILE), index=False)
+    print(results.to_string(index=False))
+
+    best = results.iloc[0]
+    best_dir = os.path.join(output_dir, BEST_DIR)
+    shutil.rmtree(best_dir, ignore_errors=True)
+    shutil.copytree(os.path.join(output_dir, f"trial-{int(best['trial']):03d}"), best_dir)
+    with open(os.path.join(best_dir, 'params.json'), 'w') as f:
+        json.dump(trial_params[int(best['trial'])], f, indent=2)
+    print(f"Best trial {int(best['trial'])} saved to {best_dir}")
+    return results
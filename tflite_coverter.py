@@ -1,11 +1,146 @@
+import json
 import os
+import time
+
+import numpy as np
 
 import tensorflow as tf
 
+from batched_yamnet import pad_batch
+
+
+# float: plain conversion, dynamic: int8 weights, float16: float16 weights, int8: int8 weights and activations
+# calibrated on training clips, float32 input and output
+QUANTIZATION_MODES = ['float', 'dynamic', 'float16', 'int8']
+
+
+def tflite_model_path(saved_model_dir, mode='float'):
+  if mode == 'float':
+    return os.path.join(saved_model_dir, 'converted_model.tflite')
+  return os.path.join(saved_model_dir, f'converted_model_{mode}.tflite')
+
+def batch_model_path(saved_model_dir):
+  return os.path.join(saved_model_dir, 'converted_model_batch.tflite')
+
+def quantize_input(details, wav):
+  """wav as the input tensor of details expects it - scaled to int8 for a full-integer model, float32 otherwise."""
+  wav = np.asarray(wav, dtype=np.float32)
+  if details['dtype'] != np.int8:
+    return wav
+  scale, zero_point = details['quantization']
+  return np.clip(np.round(wav / scale) + zero_point, -128, 127).astype(np.int8)
+
+def dequantize_output(details, values):
+  """Float logits of an output tensor, undoing the int8 scaling of a full-integer model."""
+  if details['dtype'] != np.int8:
+    return values
+  scale, zero_point = details['quantization']
+  return (values.astype(np.float32) - zero_point) * scale
+
+def evaluate_tflite(model_path, eval_data):
+  """Accuracy and mean single-thread CPU latency of a .tflite model over (waveform, class id) pairs."""
+  interpreter = tf.lite.Interpreter(model_path=model_path, num_threads=1)
+  input_details = interpreter.get_input_details()[0]
+  output_details = interpreter.get_output_details()[0]
+
+  correct = 0
+  seconds = 0.0
+  for wav, label in eval_data:
+    interpreter.resize_tensor_input(input_details['index'], [len(wav)], strict=False)
+    interpreter.allocate_tensors()
+    interpreter.set_tensor(input_details['index'], quantize_input(input_details, wav))
+    start = time.perf_counter()
+    interpreter.invoke()
+    seconds += time.perf_counter() - start
+    logits = dequantize_output(output_details, interpreter.get_tensor(output_details['index']))
+    correct += int(np.argmax(logits) == label)
 
-def export_tflite(saved_model_dir):
-  converter = tf.lite.TFLiteConverter.from_saved_model(saved_model_dir)
+  return {
+    'size_bytes': os.path.getsize(model_path),
+    'latency_ms': seconds / len(eval_data) * 1000,
+    'accuracy': correct / len(eval_data),
+  }
+
+def export_tflite(saved_model_dir, mode='float', representative_wavs=None, eval_data=None, float_metrics=None):
+  """Convert the SavedModel with the given quantization mode.
+
+  int8 quantizes weights and activations, calibrated on representative_wavs (16 kHz training waveforms). YAMNet's
+  log-mel frontend (RFFT2D, ComplexAbs, Log) has no int8 kernels and stays float, and the input and output stay
+  float32 - a waveform rounded to 256 levels would zero out quiet audio. If eval_data is given, a report comparing size, latency and accuracy with the float model is saved next
+  to the converted model - float_metrics is the float model's evaluate_tflite over eval_data, if already known.
+  """
+  # only the single-clip signature, so every converted model keeps one waveform input
+  converter = tf.lite.TFLiteConverter.from_saved_model(saved_model_dir, signature_keys=['serving_default'])
+  if mode == 'dynamic':
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+  elif mode == 'float16':
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.target_spec.supported_types = [tf.float16]
+  elif mode == 'int8':
+    if not representative_wavs:
+      raise ValueError('int8 export needs representative_wavs to calibrate on')
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = lambda: ([np.asarray(wav, dtype=np.float32)] for wav in representative_wavs)
+    # int8 kernels where they exist, float builtins for the frontend ops that have none
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8, tf.lite.OpsSet.TFLITE_BUILTINS]
+  elif mode != 'float':
+    raise ValueError(f'unknown quantization mode {mode}, expected one of {QUANTIZATION_MODES}')
   tflite_model = converter.convert()
 
-  converted_model_path = os.path.join(saved_model_dir, 'converted_model.tflite')
-  open(converted_model_path, "wb").write(tflite_model)
\ No newline at end of file
+  converted_model_path = tflite_model_path(saved_model_dir, mode)
+  open(converted_model_path, "wb").write(tflite_model)
+
+  if eval_data is not None:
+    if float_metrics is None:
+      float_metrics = evaluate_float(saved_model_dir, eval_data)
+    report = {
+      'mode': mode,
+      'eval_clips': len(eval_data),
+      'float': float_metrics,
+      mode: evaluate_tflite(converted_model_path, eval_data),
+    }
+    report['size_ratio'] = report[mode]['size_bytes'] / report['float']['size_bytes']
+    report['speedup'] = report['float']['latency_ms'] / report[mode]['latency_ms']
+    report['accuracy_delta'] = report[mode]['accuracy'] - report['float']['accuracy']
+    with open(os.path.splitext(converted_model_path)[0] + '_report.json', 'w') as f:
+      json.dump(report, f, indent=2)
+    print(f"{mode}: {report['size_ratio']:.2f}x size, {report['speedup']:.2f}x speed, "
+          f"{report['accuracy_delta'] * 100:+.2f}% accuracy vs float")
+
+  return converted_model_path
+
+def evaluate_float(saved_model_dir, eval_data):
+  """evaluate_tflite of the float model, converted first if it is missing."""
+  float_model_path = tflite_model_path(saved_model_dir)
+  if not os.path.isfile(float_model_path):
+    export_tflite(saved_model_dir)
+  return evaluate_tflite(float_model_path, eval_data)
+
+def export_quantized(saved_model_dir, modes, representative_wavs, eval_data):
+  """export_tflite in each mode with its report, the float model evaluated once for all of them."""
+  float_metrics = evaluate_float(saved_model_dir, eval_data)
+  return [export_tflite(saved_model_dir, mode, representative_wavs, eval_data, float_metrics) for mode in modes]
+
+def export_tflite_batch(saved_model_dir, wavs, tolerance=1e-4):
+  """Convert the serving_batch signature (padded waveforms and their lengths) to its own float .tflite model.
+
+  Its output for the clips in wavs is checked against the single-clip float model, a ValueError past tolerance.
+  """
+  converter = tf.lite.TFLiteConverter.from_saved_model(saved_model_dir, signature_keys=['serving_batch'])
+  converted_model_path = batch_model_path(saved_model_dir)
+  open(converted_model_path, "wb").write(converter.convert())
+
+  float_model_path = tflite_model_path(saved_model_dir)
+  if not os.path.isfile(float_model_path):
+    export_tflite(saved_model_dir)
+  single = tf.lite.Interpreter(model_path=float_model_path).get_signature_runner('serving_default')
+  batch = tf.lite.Interpreter(model_path=converted_model_path).get_signature_runner('serving_batch')
+
+  waveforms, lengths = pad_batch(wavs)
+  batched = batch(audio=waveforms, lengths=lengths)['classifier']
+  expected = np.stack([single(audio=np.asarray(wav, dtype=np.float32))['classifier'] for wav in wavs])
+  difference = float(np.abs(batched - expected).max())
+  if difference > tolerance:
+    raise ValueError(f'{converted_model_path} differs from {float_model_path} by {difference} over {len(wavs)} clips')
+  print(f'batch: {len(wavs)} clips within {difference:.2e} of the single-clip model')
+  return converted_model_path
@@ -0,0 +1,125 @@
+import math
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from resample import resampler
+from segments import wav_memmap
+
+
+SAMPLE_RATE = 16000
+EMBEDDING_SIZE = 1024
+# YAMNet frames: 0.96 s patches every 0.48 s
+HOP_SECONDS = 0.48
+PATCH_SECONDS = 0.96
+HOP_SAMPLES = 7680
+# samples behind one patch: 96 STFT hops of 10 ms plus one 25 ms STFT window
+PATCH_SAMPLES = 15600
+# frames per YAMNet call
+CHUNK_FRAMES = 1024
+
+
+def num_frames(num_samples: int):
+    """ Number of frames YAMNet returns for num_samples of 16 kHz audio, the last patch padded with silence. """
+    if num_samples <= PATCH_SAMPLES:
+        return 1
+    return 1 + math.ceil((num_samples - PATCH_SAMPLES) / HOP_SAMPLES)
+
+def timeline_path(timeline_dir: str, source_path: str):
+    name = os.path.splitext(os.path.basename(source_path.replace('\\', '/')))[0]
+    return os.path.join(timeline_dir, name + '.npy')
+
+def compute_timeline(yamnet_model, source_path: str, output_path: str, chunk_frames: int = CHUNK_FRAMES):
+    """ Run YAMNet once over a whole recording, chunk by chunk, and save its (frames, 1024) embedding timeline.
+
+    A chunk of N frames gets exactly the 16 kHz samples behind those frames, so frame i of the timeline is the frame
+    YAMNet would produce for the whole recording at i * 0.48 s. Each chunk's samples are that range of resampling the
+    whole recording (resample.Resampler.block), so chunk edges see no resampler edge effects.
+    The timeline is written through a memory-mapped .npy, memory stays at one chunk.
+    """
+    samples, rate = wav_memmap(source_path)
+    resampler_16k = resampler(rate, SAMPLE_RATE)
+
+    total_samples = len(samples) * SAMPLE_RATE // rate
+    total_frames = num_frames(total_samples)
+    timeline = np.lib.format.open_memmap(output_path, mode='w+', dtype=np.float32, shape=(total_frames, EMBEDDING_SIZE))
+
+    for first in range(0, total_frames, chunk_frames):
+        frames = min(chunk_frames, total_frames - first)
+        start = first * HOP_SAMPLES
+        end = min(start + HOP_SAMPLES * (frames - 1) + PATCH_SAMPLES, total_samples)
+        _, embeddings, _ = yamnet_model(resampler_16k.block(samples[:, 0], start, end))
+        timeline[first:first + frames] = embeddings.numpy()[:frames]
+
+    timeline.flush()
+    return total_frames
+
+def build_timelines(yamnet_model, index_path: str, timeline_dir: str):
+    """ compute_timeline of every source of a segment index that has no saved timeline yet. """
+    os.makedirs(timeline_dir, exist_ok=True)
+    for source in pd.read_csv(index_path)['source'].unique():
+        output_path = timeline_path(timeline_dir, source)
+        if os.path.isfile(output_path):
+            continue
+        frames = compute_timeline(yamnet_model, source, output_path)
+        print(f'{source}: {frames} frames')
+
+def frame_range(start_seconds: float, end_seconds: float, total_frames: int):
+    """ [first, last) timeline frames whose 0.96 s patch lies inside the interval.
+
+    An interval shorter than one patch gets the single frame starting closest before it, like YAMNet pads a short clip.
+    """
+    first = math.ceil(start_seconds / HOP_SECONDS - 1e-9)
+    last = math.floor((end_seconds - PATCH_SECONDS) / HOP_SECONDS + 1e-9) + 1
+    if last <= first:
+        first = math.floor(start_seconds / HOP_SECONDS)
+        last = first + 1
+    return min(first, total_frames - 1), min(last, total_frames)
+
+def load_timelines(index_path: str, timeline_dir: str, dataset: str = 'sleep_scoring'):
+    """ train/validation/eval splits of a segment index, as (frame embeddings, repeated one-hot label) per segment.
+
+    Examples are cut from the saved per-night timelines by frame range, so re-labelling or re-segmenting only needs a
+    new index, not another YAMNet pass.
+    """
+    import tensorflow as tf
+    from data import dataset_classes
+
+    classes, map_class_to_id, new_classes = dataset_classes(dataset)
+    index = pd.read_csv(index_path)
+    index = index[index['label'].isin(classes)]
+    timelines = {source: np.load(timeline_path(timeline_dir, source), mmap_mode='r') for source in index['source'].unique()}
+    labels = np.eye(len(new_classes), dtype=np.float32)
+
+    def dataset_of(rows):
+        rows = rows.to_dict('records')
+
+        def generator():
+            for row in rows:
+                timeline = timelines[row['source']]
+                first, last = frame_range(row['start'] / row['rate'], row['end'] / row['rate'], len(timeline))
+                embeddings = np.asarray(timeline[first:last])
+                yield embeddings, np.repeat(labels[None, map_class_to_id[row['label']]], len(embeddings), axis=0)
+
+        return tf.data.Dataset.from_generator(
+            generator,
+            output_signature=(
+                tf.TensorSpec(shape=(None, EMBEDDING_SIZE), dtype=tf.float32),
+                tf.TensorSpec(shape=(None, len(new_classes)), dtype=tf.float32)
+            )
+        )
+
+    splited_dataset = {}
+    for split in ['train', 'validation', 'eval']:
+        splited_dataset[split] = dataset_of(index[index['split'] == split])
+    return splited_dataset, new_classes
+
+
+if __name__ == '__main__':
+    # usage: python timeline.py <segments.csv> <timeline dir>
+    from models import import_model
+
+    yamnet_model, _ = import_model('yamnet')
+    build_timelines(yamnet_model, sys.argv[1], sys.argv[2])
@@ -0,0 +1,223 @@
+import json
+import sys
+import threading
+import time
+
+import numpy as np
+
+from batched_yamnet import clip_mean, PATCHES_PER_CALL, embed_clips
+from timeline import EMBEDDING_SIZE, HOP_SAMPLES, PATCH_SAMPLES, num_frames
+
+
+# a patch is silence when it is both quiet (mean power in dBFS) and noise-like (spectral flatness, 1 for white noise)
+ENERGY_DB = -55.0
+FLATNESS = 0.25
+FFT_SIZE = 16384
+EPS = 1e-10
+# embedding: silent frames get YAMNet's embedding of a silent patch, decision: they are dropped and a clip with no
+# other frames is scored DECISION_CLASS directly
+MODES = ['embedding', 'decision']
+# 'wake', the class NONE maps to in data.dataset_classes
+DECISION_CLASS = 0
+
+
+def padded_patches(wav):
+    """ (padded waveform, (frames, 15600) view of its patches) - the zero padding and 0.96 s patches YAMNet uses. """
+    wav = np.asarray(wav, dtype=np.float32)
+    padded = np.zeros(HOP_SAMPLES * (num_frames(len(wav)) - 1) + PATCH_SAMPLES, dtype=np.float32)
+    padded[:len(wav)] = wav
+    return padded, np.lib.stride_tricks.sliding_window_view(padded, PATCH_SAMPLES)[::HOP_SAMPLES]
+
+def frame_features(wav):
+    """ (energy in dBFS, spectral flatness) of each YAMNet patch of a 16 kHz clip. """
+    _, patches = padded_patches(wav)
+    energy_db = 10 * np.log10(np.mean(np.square(patches, dtype=np.float64), axis=1) + EPS)
+    power = np.square(np.abs(np.fft.rfft(patches, n=FFT_SIZE, axis=1))) + EPS
+    flatness = np.exp(np.mean(np.log(power), axis=1)) / np.mean(power, axis=1)
+    return energy_db, flatness
+
+def runs(mask):
+    """ [start, end) of each run of True in a boolean array. """
+    edges = np.flatnonzero(np.diff(np.concatenate([[0], mask.astype(np.int8), [0]])))
+    return edges.reshape(-1, 2)
+
+
+class SilenceFilter:
+    """ Energy and spectral flatness pre-filter that keeps silent patches away from YAMNet.
+
+    The patches of a clip left after the filter are cut out of its padded waveform and embedded together with
+    batched_yamnet.embed_clips, so each of them gets exactly the embedding YAMNet gives it in the whole clip.
+    Counts every frame it sees and how many were skipped, see report.
+    """
+
+    def __init__(self, mode='embedding', energy_db=ENERGY_DB, flatness=FLATNESS):
+        if mode not in MODES:
+            raise ValueError(f'unknown silence filter mode {mode}, expected one of {MODES}')
+        self.mode = mode
+        self.energy_db = energy_db
+        self.flatness = flatness
+        self.silence = None
+        self.frames = 0
+        self.skipped = 0
+        self._lock = threading.Lock()
+
+    @property
+    def version(self):
+        """ Tag for embedding_store keys, filtered embeddings never mix with unfiltered ones. """
+        return f'vad-{self.mode}-{self.energy_db:g}-{self.flatness:g}'
+
+    def silent(self, wav):
+        """ Boolean mask of the clip's patches that are silence, counted into the report. """
+        energy_db, flatness = frame_features(wav)
+        mask = (energy_db < self.energy_db) & (flatness > self.flatness)
+        with self._lock:
+            self.frames += len(mask)
+            self.skipped += int(mask.sum())
+        return mask
+
+    def tf_silent(self, patches):
+        """ silent of a (frames, 15600) tensor of patches, in TensorFlow ops for the serving graph, not counted. """
+        import tensorflow as tf
+
+        energy_db = 10 * tf.math.log(tf.reduce_mean(tf.square(patches), axis=1) + EPS) / float(np.log(10.0))
+        power = tf.square(tf.abs(tf.signal.rfft(patches, fft_length=[FFT_SIZE]))) + EPS
+        flatness = tf.exp(tf.reduce_mean(tf.math.log(power), axis=1)) / tf.reduce_mean(power, axis=1)
+        return (energy_db < self.energy_db) & (flatness > self.flatness)
+
+    def clip_logits(self, yamnet_model, head, embeddings, patches, membership):
+        """ (clips, classes) mean head logits of clips in a serving graph, their silent frames handled as embed does.
+
+        embeddings and patches are the (frames, ...) of all clips, membership the (clips, frames) 0/1 matrix of which
+        frames belong to which clip. In embedding mode silent frames score as the silence embedding, in decision mode
+        they leave the mean and a clip with no other frames gets logits that put all of softmax on DECISION_CLASS - so
+        the exported model scores what the head was trained on and clip_prediction scores in evaluate_filter.
+        """
+        import tensorflow as tf
+
+        silent = self.tf_silent(patches)
+        if self.mode == 'embedding':
+            silence = tf.constant(self.silence_embedding(yamnet_model))
+            return clip_mean(head(tf.where(silent[:, None], silence[None], embeddings)), membership)
+        kept = membership * (1 - tf.cast(silent, tf.float32))[None]
+        frames = tf.reduce_sum(kept, axis=1, keepdims=True)
+        logits = tf.matmul(kept, head(embeddings)) / tf.maximum(frames, 1)
+        decision = tf.math.log(tf.one_hot(DECISION_CLASS, tf.shape(logits)[1]) + EPS)
+        return tf.where(frames > 0, logits, decision[None])
+
+    def decide(self, wav):
+        """ True if every patch of the clip is silence, it is then DECISION_CLASS without running any model. """
+        return bool(self.silent(wav).all())
+
+    def silence_embedding(self, yamnet_model):
+        """ YAMNet's embedding of an all-zero patch, computed once. """
+        if self.silence is None:
+            _, embeddings, _ = yamnet_model(np.zeros(PATCH_SAMPLES, dtype=np.float32))
+            self.silence = embeddings.numpy()[0]
+        return self.silence
+
+    def embed(self, yamnet_model, wavs, patches_per_call=PATCHES_PER_CALL):
+        """ embed_clips of each clip with its silent frames skipped.
+
+        In embedding mode a clip keeps all of its frames, the silent ones set to silence_embedding. In decision mode
+        only its other frames are returned, none for a clip that is all silence.
+        """
+        pieces = []
+        layouts = []
+        for wav in wavs:
+            padded, _ = padded_patches(wav)
+            mask = self.silent(wav)
+            kept = runs(~mask)
+            pieces += [padded[HOP_SAMPLES * start:HOP_SAMPLES * (end - 1) + PATCH_SAMPLES] for start, end in kept]
+            layouts.append((len(mask), kept))
+
+        embedded = iter(embed_clips(yamnet_model, pieces, patches_per_call) if pieces else [])
+        silence = self.silence_embedding(yamnet_model) if self.mode == 'embedding' else None
+        embeddings = []
+        for frames, kept in layouts:
+            if silence is None:
+                embeddings.append(np.concatenate([next(embedded) for _ in kept]) if len(kept)
+                                  else np.zeros((0, EMBEDDING_SIZE), dtype=np.float32))
+                continue
+            clip = np.repeat(silence[None], frames, axis=0)
+            for start, end in kept:
+                clip[start:end] = next(embedded)
+            embeddings.append(clip)
+        return embeddings
+
+    def report(self):
+        return {
+            'mode': self.mode,
+            'energy_db': self.energy_db,
+            'flatness': self.flatness,
+            'frames': self.frames,
+            'skipped_frames': self.skipped,
+            'skipped_fraction': self.skipped / self.frames if self.frames else 0.0,
+        }
+
+
+def clip_prediction(head, embeddings):
+    """ Class id of a clip from its frame embeddings - the serving model's mean logits, DECISION_CLASS if none. """
+    if len(embeddings) == 0:
+        return DECISION_CLASS
+    return int(np.argmax(head(embeddings, training=False).numpy().mean(axis=0)))
+
+def timed(fn, *args):
+    """ (fn(*args), seconds it took). """
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+def evaluate_filter(yamnet_model, baseline_head, head, eval_data, silence_filter, report_path=None):
+    """ Skipped frames, YAMNet time saved and accuracy change of a SilenceFilter over (waveform, class id) pairs.
+
+    baseline_head, trained on unfiltered embeddings, scores every clip's unfiltered embeddings and head, trained on
+    the filter's embeddings, its filtered ones - each pipeline as it would be deployed. Both passes run once on the
+    first clip before they are timed, so neither pays for YAMNet's tracing, and the filter's feature time counts
+    against its savings.
+    """
+    wavs = [wav for wav, _ in eval_data]
+    labels = np.array([label for _, label in eval_data])
+
+    embed_clips(yamnet_model, wavs[:1])
+    silence_filter.embed(yamnet_model, wavs[:1])
+    counted = silence_filter.frames, silence_filter.skipped
+    baseline, baseline_seconds = timed(embed_clips, yamnet_model, wavs)
+    filtered, filtered_seconds = timed(silence_filter.embed, yamnet_model, wavs)
+    frames = silence_filter.frames - counted[0]
+    skipped = silence_filter.skipped - counted[1]
+
+    baseline_preds = np.array([clip_prediction(baseline_head, embeddings) for embeddings in baseline])
+    filtered_preds = np.array([clip_prediction(head, embeddings) for embeddings in filtered])
+    report = dict(silence_filter.report(), clips=len(wavs))
+    report.update({
+        'frames': frames,
+        'skipped_frames': skipped,
+        'skipped_fraction': skipped / frames if frames else 0.0,
+        'baseline_seconds': baseline_seconds,
+        'filtered_seconds': filtered_seconds,
+        'compute_saved': 1 - filtered_seconds / baseline_seconds,
+        'baseline_accuracy': float(np.mean(baseline_preds == labels)),
+        'filtered_accuracy': float(np.mean(filtered_preds == labels)),
+        'changed_predictions': int(np.sum(baseline_preds != filtered_preds)),
+    })
+    report['accuracy_delta'] = report['filtered_accuracy'] - report['baseline_accuracy']
+    if report_path is not None:
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=2)
+    print(f"vad: {report['skipped_fraction'] * 100:.1f}% of frames skipped, {report['compute_saved'] * 100:.1f}% "
+          f"YAMNet time saved, {report['accuracy_delta'] * 100:+.2f}% accuracy")
+    return report
+
+
+if __name__ == '__main__':
+    # usage: python vad.py <clip.wav> [...] - energy, flatness and silence decision of every patch
+    from data import load_wav_16k_mono
+
+    silence_filter = SilenceFilter()
+    for path in sys.argv[1:]:
+        wav = load_wav_16k_mono(path).numpy()
+        energy_db, flatness = frame_features(wav)
+        mask = silence_filter.silent(wav)
+        for frame, (energy, flat, silent) in enumerate(zip(energy_db, flatness, mask)):
+            print(f'{path},{frame},{energy:.1f},{flat:.3f},{int(silent)}')
+    print(silence_filter.report())